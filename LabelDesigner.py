@@ -5,27 +5,32 @@
 This is a web service to print labels on Dymo 450 label printers.
 """
 
-import sys, logging, random, json, argparse
-from io import BytesIO
-import os
+import os, sys, math, logging, random, json, argparse, hashlib, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor, CancelledError
 from datetime import date
-import time
-import re
 
-from bottle import run, route, get, post, response, request, jinja2_view as view, static_file, redirect
-from PIL import Image, ImageDraw, ImageFont
+from bottle import run, route, get, post, hook, response, request, jinja2_view as view, static_file, redirect
 
-from barcode import Code128
-from barcode.writer import ImageWriter
-from PyPDF2 import PdfReader, PdfWriter
-import cups
-
-from pygrocy import Grocy
-
-from font_helpers import get_fonts
+from font_helpers import FONT_CACHE, FONT_DIRS, FontIndex, get_fonts, preload_fonts
+from label_helpers import render_label_image, render_label_png, render_label_pdf, render_label_raster, render_label_vector_pdf, label_layout, raster_context, RenderPool
+from pdf_helpers import images_to_pdf_bytes
+from vector_pdf_helpers import layouts_to_vector_pdf
+from dymo_helpers import labels_to_raster, send_raw
+from cups_helpers import print_bytes, ConnectionPool, JobMonitor
+from grocy_helpers import ProductCatalog, ProductLookup, ProductSearchIndex
+from server_helpers import get_server, LatestRequestTracker, PrintQueue, QueueFull
+from cache_helpers import LRUCache
+from text_helpers import METRICS_CACHE
+from metrics_helpers import REGISTRY, span, add_spans, collect_spans, start_spans, finish_spans
 
 logger = logging.getLogger(__name__)
 
+# CONFIG, FONTS and DEBUG are set up once in main() before the server starts.
+# The request handlers (which may run concurrently, see SERVER.SERVER in
+# config.json) only read them and keep per-request state in their context.
+DEBUG = False
+FONTS = {}
+
 LABEL_SIZES = [
     ('57x32', '57mm x 32mm'),
     ('54x25', '54mm x 25mm')
@@ -38,8 +43,82 @@ except FileNotFoundError as e:
     with open('config.example.json', encoding='utf-8') as fh:
         CONFIG = json.load(fh)
 
-if CONFIG['GROCY']['ENABLE']:
-    grocy = Grocy(CONFIG['GROCY']['URI'], CONFIG['GROCY']['API_KEY'], port = CONFIG['GROCY']['PORT'], verify_ssl = CONFIG['GROCY']['SSL'])
+cups_pool = ConnectionPool(size = CONFIG['PRINTER'].get('CONNECTION_POOL_SIZE', 4))
+render_pool = RenderPool()
+preview_cache = LRUCache(maxsize = 1024, max_bytes = CONFIG['SERVER'].get('PREVIEW_CACHE_MB', 32) * 1024 * 1024)
+PREVIEW_IGNORED_KEYS = ('numCopies', 'debug')
+preview_tracker = LatestRequestTracker()
+job_monitor = JobMonitor(cups_pool, interval = CONFIG['PRINTER'].get('JOB_POLL_INTERVAL', 2))
+print_queue = PrintQueue(workers     = CONFIG['PRINTER'].get('QUEUE_WORKERS', 1),
+                         max_pending = CONFIG['PRINTER'].get('QUEUE_SIZE', 16),
+                         window      = CONFIG['PRINTER'].get('DEDUP_WINDOW', 60))
+
+# metrics served at /metrics, the stage spans are recorded per request (see the request hooks)
+REQUESTS       = REGISTRY.counter('labeldesigner_requests_total', 'HTTP requests by route and status code', ('route', 'status'))
+REQUEST_SECONDS = REGISTRY.histogram('labeldesigner_request_duration_seconds', 'HTTP request latency by route', ('route',))
+STAGE_SECONDS  = REGISTRY.histogram('labeldesigner_stage_duration_seconds',
+                                    'Time spent per pipeline stage (grocy, render, font, text, barcode, png, pdf, raster, cups, send) by route', ('route', 'stage'))
+PRINT_JOBS     = REGISTRY.counter('labeldesigner_print_jobs_total', 'Print jobs by final CUPS job state, submit_failed if CUPS refused the job', ('state',))
+job_monitor.listeners.append(lambda job: PRINT_JOBS.inc(state = job['state']))
+
+# the Grocy client is created on first use or by the warm-up thread, see setup_grocy()
+grocy = None
+product_catalog = None
+product_lookup = None
+product_index = None
+grocy_lock = threading.Lock()
+
+# set by the warm-up thread started in main(), reported by /api/ready
+WARMUP = {'fonts': False, 'render_pool': False, 'seconds': None}
+
+def setup_grocy():
+    """ creates the Grocy client and its caches unless Grocy is disabled or they exist already """
+    global grocy, product_catalog, product_lookup, product_index
+    if grocy is not None or not CONFIG['GROCY']['ENABLE']:
+        return
+    with grocy_lock:
+        if grocy is not None:
+            return
+        from pygrocy import Grocy  # slow to import, so only loaded when Grocy is enabled
+        client = Grocy(CONFIG['GROCY']['URI'], CONFIG['GROCY']['API_KEY'], port = CONFIG['GROCY']['PORT'], verify_ssl = CONFIG['GROCY']['SSL'])
+        catalog = ProductCatalog(client, ttl = CONFIG['GROCY'].get('CATALOG_TTL', 300))
+        lookup = ProductLookup(client, maxsize = CONFIG['GROCY'].get('LOOKUP_CACHE_SIZE', 512), ttl = CONFIG['GROCY'].get('LOOKUP_CACHE_TTL', 600))
+        if CONFIG['GROCY'].get('LOOKUP_CACHE_PREWARM', True):
+            catalog.listeners.append(lookup.prewarm)
+        index = ProductSearchIndex(alias_userfield = CONFIG['GROCY'].get('ALIAS_USERFIELD', 'kurzname'))
+        catalog.listeners.append(index.rebuild)
+        product_catalog, product_lookup, product_index = catalog, lookup, index
+        grocy = client
+
+def warm_up(font_paths, font_sizes):
+    """
+    runs in the background after startup: preloads fonts, starts the render workers and the Grocy catalog.
+    Every step is tried on its own, so e.g. an unreachable Grocy doesn't keep /api/ready at 503.
+    """
+    started = time.monotonic()
+
+    def load_cups():
+        import cups  # pycups is not imported at startup, load it here rather than on the first print (PIL comes with the fonts)
+
+    def start_grocy():
+        setup_grocy()
+        if product_catalog is not None:
+            product_catalog.start()
+
+    def step(name, func):
+        try:
+            func()
+            return True
+        except Exception as e:
+            logger.warning('Warm-up of %s failed: %s', name, e)
+            return False
+
+    WARMUP['fonts'] = step('the fonts', lambda: preload_fonts(font_paths, font_sizes))
+    WARMUP['render_pool'] = step('the render workers', render_pool.warm)
+    step('pycups', load_cups)
+    step('Grocy', start_grocy)
+    WARMUP['seconds'] = round(time.monotonic() - started, 3)
+    logger.info('Warm-up finished after %s s', WARMUP['seconds'])
 
 @route('/')
 def index():
@@ -58,23 +137,169 @@ def labeldesigner():
             'label_sizes': LABEL_SIZES,
             'website': CONFIG['WEBSITE'],
             'label': CONFIG['LABEL'],
-            'grcy_products' : get_grocy_products()
             }
-    
-def get_grocy_products():
-    all_products = grocy.all_products()
-    product_list = []
-    for product in all_products:
-        product_list.append([product.id,product.name])
-    return product_list
+
+@get('/api/grocy/products')
+def api_grocy_products():
+    """
+    API endpoint serving the cached Grocy product catalog.
+
+    returns: JSON
+    """
+    setup_grocy()
+    if product_catalog is None:
+        return {'success': False, 'error': 'Grocy is not enabled', 'products': []}
+    return {'success': True,
+            'stale': product_catalog.is_stale(),
+            'products': product_catalog.products()}
+
+@get('/api/grocy/search')
+def api_grocy_search():
+    """
+    API endpoint searching the cached Grocy product catalog by name, alias and barcode
+    (prefix and similarity matching, see ProductSearchIndex).
+
+    expects: q (search text, empty for all products), offset (default 0) and limit (default 20, at most 100)
+    returns: JSON with the total number of matches and one page of products;
+             "loading" is true while the catalog isn't loaded yet
+    """
+    setup_grocy()
+    if product_index is None:
+        return {'success': False, 'error': 'Grocy is not enabled', 'products': []}
+    try:
+        offset = max(int(request.query.get('offset', 0)), 0)
+        limit  = min(max(int(request.query.get('limit', 20)), 1), 100)
+    except ValueError:
+        return {'success': False, 'error': 'offset and limit must be numbers', 'products': []}
+    stale = product_catalog.is_stale()
+    if stale: product_catalog.refresh_async()
+    query = request.query.getunicode('q', '')
+    total, products = product_index.search(query, offset, limit)
+    return {'success':  True,
+            'loading':  not product_index.loaded,
+            'stale':    stale,
+            'query':    query,
+            'total':    total,
+            'offset':   offset,
+            'limit':    limit,
+            'products': products}
+
+@post('/api/grocy/products/refresh')
+@get('/api/grocy/products/refresh')
+def api_grocy_products_refresh():
+    """
+    API endpoint to invalidate the cached Grocy product catalog,
+    e.g. after products were added or renamed in Grocy.
+
+    returns: JSON
+    """
+    setup_grocy()
+    if product_catalog is None:
+        return {'success': False, 'error': 'Grocy is not enabled'}
+    product_lookup.invalidate()
+    product_catalog.invalidate()
+    return {'success': True}
+
+@get('/api/grocy/cache')
+def api_grocy_cache():
+    """
+    API endpoint reporting size and hit/miss counters of the Grocy lookup caches.
+
+    returns: JSON
+    """
+    setup_grocy()
+    if product_lookup is None:
+        return {'success': False, 'error': 'Grocy is not enabled'}
+    return {'success': True, 'caches': product_lookup.stats()}
+
+@hook('before_request')
+def start_request_metrics():
+    request.environ['labeldesigner.started'] = time.perf_counter()
+    start_spans()
+
+@hook('after_request')
+def record_request_metrics():
+    route = request.environ.get('bottle.route')
+    rule = route.rule if route is not None else 'unmatched'
+    REQUESTS.inc(route = rule, status = response.status_code)
+    started = request.environ.get('labeldesigner.started')
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route = rule)
+    for stage, seconds in finish_spans().items():
+        STAGE_SECONDS.observe(seconds, route = rule, stage = stage)
+
+def collect_metrics():
+    """ statistics of the caches (of the server process, render workers keep their own), CUPS connections and print queue """
+    caches = {'preview': preview_cache, 'font': FONT_CACHE, 'text_metrics': METRICS_CACHE}
+    if 'barcode_helpers' in sys.modules:
+        caches['barcode'] = sys.modules['barcode_helpers'].BARCODE_CACHE
+    if 'template_helpers' in sys.modules:
+        caches['label_templates'] = sys.modules['template_helpers'].TEMPLATE_CACHE
+    if product_lookup is not None:
+        caches['grocy_products'] = product_lookup.products
+        caches['grocy_userfields'] = product_lookup.userfields
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    pool = cups_pool.stats()
+    queue = print_queue.stats()
+    return [
+        ('labeldesigner_cache_hits_total',      'counter', 'Cache hits',        [({'cache': name}, s['hits'])      for name, s in stats.items()]),
+        ('labeldesigner_cache_misses_total',    'counter', 'Cache misses',      [({'cache': name}, s['misses'])    for name, s in stats.items()]),
+        ('labeldesigner_cache_evictions_total', 'counter', 'Cache evictions',   [({'cache': name}, s['evictions']) for name, s in stats.items()]),
+        ('labeldesigner_cache_entries',         'gauge',   'Cached entries',    [({'cache': name}, s['size'])      for name, s in stats.items()]),
+        ('labeldesigner_cups_connections_created_total',   'counter', 'CUPS connections opened',    [({}, pool['created'])]),
+        ('labeldesigner_cups_connections_discarded_total', 'counter', 'CUPS connections discarded', [({}, pool['discarded'])]),
+        ('labeldesigner_print_queue_pending',          'gauge',   'Print jobs waiting or running in the print queue', [({}, queue['pending'])]),
+        ('labeldesigner_print_queue_duplicates_total', 'counter', 'Print requests dropped as duplicates',            [({}, queue['duplicates'])]),
+        ('labeldesigner_print_queue_rejected_total',   'counter', 'Print requests rejected with 429 (queue full)',   [({}, queue['rejected'])]),
+    ]
+
+REGISTRY.collectors.append(collect_metrics)
+
+@get('/metrics')
+def metrics():
+    """
+    Prometheus metrics: requests, request and pipeline stage latencies,
+    cache statistics and the outcome of the print jobs.
+
+    returns: text in the Prometheus exposition format
+    """
+    response.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    return REGISTRY.render()
+
+@get('/api/ready')
+def api_ready():
+    """
+    Readiness check: responds 200 once the fonts are loaded and the render
+    workers are running, 503 before. The Grocy catalog is reported but
+    doesn't block readiness, text labels can be printed without it.
+
+    returns: JSON
+    """
+    ready = WARMUP['fonts'] and WARMUP['render_pool']
+    if not ready:
+        response.status = 503
+    if not CONFIG['GROCY']['ENABLE']:
+        grocy_state = 'disabled'
+    else:
+        grocy_state = 'loaded' if product_catalog is not None and product_catalog.loaded else 'loading'
+    return {'success': ready,
+            'warmup': dict(WARMUP),
+            'grocy': grocy_state,
+            'caches': {'preview': preview_cache.stats(),
+                       'fonts':   FONT_CACHE.stats()}}
 
 def change_grocy_context(context):
+    setup_grocy()
     if context['print_alias']:
-        product = grocy.product_by_barcode(context['grocycode'])
-        alias_name = grocy.get_userfields("products",product.id).get(context['alias_userfield'])
-        context["product"] = product.name if context["product"] == None else context["product"]
-        if alias_name is not None and 0 < len(alias_name) < len(context["product"]):
-            context["product"] = alias_name
+        with span('grocy'):
+            product = product_lookup.product_by_barcode(context['grocycode'])
+            if product is None and context['product'] is None and context['text'] in (None, ' '):
+                raise LookupError(f"Unknown grocycode {context['grocycode']}")
+            if product is not None:
+                alias_name = product_lookup.get_userfields(product['id']).get(context['alias_userfield'])
+                context["product"] = product['name'] if context["product"] == None else context["product"]
+                if alias_name is not None and 0 < len(alias_name) < len(context["product"]):
+                    context["product"] = alias_name
 
     if context['text'] is not None:
         context['product'] =  context['text'] if context['text'] != ' ' else context['product']
@@ -90,9 +315,18 @@ def change_grocy_context(context):
 def get_label_context(request):
     """ might raise LookupError() """
     d = request.params.decode() # UTF-8 decoded form data
+    return label_context_from_params(d)
 
-    font_family = d.get('font_family').rpartition('(')[0].strip()
-    font_style  = d.get('font_family').rpartition('(')[2].rstrip(')')
+def label_context_from_params(d):
+    """
+    builds the label context from a mapping of request parameters
+    (form data or one label of a batch); might raise LookupError()
+    """
+    font_family = None
+    font_style  = None
+    if d.get('font_family') is not None:
+        font_family = d.get('font_family').rpartition('(')[0].strip()
+        font_style  = d.get('font_family').rpartition('(')[2].rstrip(')')
 
     printGrocy =     False if str(d.get('printGrocy', 'false')).lower() == 'false' else True
     print_alias =    False if str(d.get('print_alias', CONFIG['GROCY']['PRINT_ALIAS'])).lower() == 'false'       else True
@@ -101,9 +335,10 @@ def get_label_context(request):
     print_today =    False if str(d.get('print_today', CONFIG['GROCY']['PRINT_TODAY'])).lower() == 'false'       else True
     
     distribute_vertically = False if str(d.get('distribute_vertically', 'false')).lower() == 'false' else True
+    auto_fit =       False if str(d.get('auto_fit', CONFIG['LABEL'].get('AUTO_FIT', 'false'))).lower() == 'false' else True
     
     if DEBUG: 
-        for key in d: print(key+":"+d.get(key))
+        for key in d: print(key+":"+str(d.get(key)))
         
     context = {
       'text':           d.get('text', None),
@@ -116,7 +351,7 @@ def get_label_context(request):
       'print_due_date': print_due_date,
       'print_today':    print_today,
       'print_date':     print_date,
-      'alias_userfield':d.get('alias_userfield', 'kurzname'),
+      'alias_userfield':d.get('alias_userfield', CONFIG['GROCY'].get('ALIAS_USERFIELD', 'kurzname')),
       'width':          int(d.get('label_size', CONFIG['LABEL']['DEFAULT_SIZE']).rpartition('x')[0].rstrip()),
       'height':         int(d.get('label_size', CONFIG['LABEL']['DEFAULT_SIZE']).rpartition('x')[2].rstrip()),
       'dpi':            d.get('dpi',300),
@@ -131,10 +366,15 @@ def get_label_context(request):
       'align':          d.get('align', 'center'),
       'vertical_align': d.get('vertical_align', 'top'),
       'topHalf':        d.get('topHalf', False),
-      'distribute_vertically': distribute_vertically
+      'distribute_vertically': distribute_vertically,
+      'auto_fit':       auto_fit
     }
     
-    context['fill_color'] = (0, 0, 0)
+    context['fill_color'] = 'black'
+    context['mode'] = CONFIG['LABEL'].get('COLOR_MODE', '1')
+    context['fast_barcode'] = CONFIG['LABEL'].get('FAST_BARCODE', True)
+    context['template'] = (CONFIG['LABEL'].get('TEMPLATES') or {}).get(f"{context['width']}x{context['height']}")
+    context['debug'] = DEBUG
     
     def get_font_path(font_family_name, font_style_name):
         try:
@@ -150,265 +390,199 @@ def get_label_context(request):
 
     return context
 
-def draw_multiline_text(img, text, font, kwargs, offset):
-    width = img.size[0] - offset[1]  # Adjust for padding if needed
-    draw = ImageDraw.Draw(img)
-
-    def tokenize(text):
-        # Split text into tokens where everything in parentheses is treated as one word
-        pattern = r'\([^)]*\)|\S+'
-        return re.findall(pattern, text)
-
-    def break_fix(text, width, font, draw):
-        tokens = tokenize(text)
-        line = []
-        for token in tokens:
-            test_line = ' '.join(line + [token])
-            x, y, w, h = draw.textbbox((0, 0), text=test_line, font=font)
-            if w <= width:
-                line.append(token)
-            else:
-                yield ' '.join(line)
-                line = [token]
-        if line:
-            yield ' '.join(line)
-
-    lines = list(break_fix(text, width, font, draw))
-    line_heights = [draw.textbbox((0, 0), text=line, font=font)[3] for line in lines]
-    total_text_height = sum(line_heights)
-
-    # Determine available space based on `topHalf`
-    max_height = img.size[1]*1.1 // 2 if kwargs.get('topHalf', False) else img.size[1]
-    available_space = max_height - total_text_height
-
-    if available_space < 0:
-        raise ValueError("Text doesn't fit within the allowed dimensions")
-
-    # Determine gap size if vertical distribution is enabled
-    distribute_vertically = kwargs.get('distribute_vertically', False)
-    if distribute_vertically:
-        num_gaps = len(lines) + 1  # gaps between lines + gaps at top and bottom
-        gap_size = available_space // num_gaps
-        y = gap_size
-    else:
-        # Handle vertical alignment
-        vertical_align = kwargs.get('vertical_align', 'top')
-        if vertical_align == 'top':
-            y = kwargs.get('margin_top', 0)
-        elif vertical_align == 'center':
-            y = (max_height - total_text_height) // 2
-        elif vertical_align == 'bottom':
-            y = max_height - total_text_height - kwargs.get('margin_bottom', 0)
-        else:
-            raise ValueError("Invalid vertical_align value. Choose from 'top', 'center', or 'bottom'.")
-        gap_size = 0  # No additional gaps for non-distributed alignment
-
-    # Handle horizontal alignment and draw each line
-    align = kwargs.get('align', 'left')
-    for i, line in enumerate(lines):
-        x, _, line_width, _ = draw.textbbox((0, 0), text=line, font=font)
-        if align == 'left':
-            x = kwargs.get('margin_left', 0)
-        elif align == 'center':
-            x = (img.size[0] - line_width) // 2
-        elif align == 'right':
-            x = img.size[0] - line_width - kwargs.get('margin_right', 0)
-        else:
-            raise ValueError("Invalid align value. Choose from 'left', 'center', or 'right'.")
-
-        draw.text((x, y), line, font=font, fill=kwargs.get('fill_color', 'black'))
-        y += line_heights[i] + gap_size
-
-    return img
+def preview_cache_key(context):
+    """ content hash of everything in the (normalized) label context that affects the rendered label """
+    relevant = {key: value for key, value in context.items() if key not in PREVIEW_IGNORED_KEYS}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:32]
 
+@get('/api/preview/text')
+@post('/api/preview/text')
+def get_preview_image():
+    context = get_label_context(request)
 
+    # the designer numbers its previews per page load ('client' and 'seq'),
+    # previews superseded by a newer one of the same client are not rendered
+    client = request.params.get('client')
+    try:
+        seq = int(request.params.get('seq', 0))
+    except ValueError:
+        seq = 0
+    if client is not None and not preview_tracker.start(client, seq):
+        response.status = 204
+        return ''
+    
+    if context['printGrocy']:
+        try:
+            context = change_grocy_context(context)
+        except LookupError as e:
+            response.status = 404
+            return {'success': False, 'error': str(e)}
+        if DEBUG: print(context)
+
+    # previews are rendered at a fraction of the print resolution
+    default_scale = CONFIG['LABEL'].get('PREVIEW_SCALE', 1)
+    try:
+        scale = float(request.params.get('preview_scale', default_scale))
+    except ValueError:
+        scale = default_scale
+    if not math.isfinite(scale):  # float() accepts 'nan' and 'inf'
+        scale = default_scale
+    context['scale'] = min(max(scale, 0.1), 1)
+    response.set_header('X-Preview-Scale', str(context['scale']))
 
+    return_format = request.query.get('return_format', 'png')
+    key = preview_cache_key(context)
+    etag = f'"{key}-{return_format}"'
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'no-cache')
+    if etag in request.headers.get('If-None-Match', ''):
+        response.status = 304
+        return ''
+
+    png = preview_cache.get(key)
+    if png is None:
+        if client is not None and preview_tracker.is_superseded(client, seq):
+            response.status = 204
+            return ''
+        with span('render'):
+            future = render_pool.submit(collect_spans, render_label_png, context)
+            if client is not None: preview_tracker.track(client, seq, future)
+            try:
+                png, render_spans = future.result()
+            except CancelledError:
+                response.status = 204
+                return ''
+            finally:
+                if client is not None: preview_tracker.done(client, seq)
+        add_spans(render_spans)
+        preview_cache.put(key, png)
+    if DEBUG and context['printGrocy']:
+        with open(debug_file_path(f"{context['grocycode']}.png"), "wb") as fh: fh.write(png)
+        
+    if return_format == 'base64':
+        import base64
+        response.set_header('Content-type', 'text/plain')
+        return base64.b64encode(png)
+    else:
+        response.set_header('Content-type', 'image/png')
+        return png
 
-def create_label_im(text, **kwargs):
-    im_font = ImageFont.truetype(kwargs['font_path'], kwargs['font_size'])
-    im = Image.new('L', (20, 20), 'white')
-    draw = ImageDraw.Draw(im)
+def debug_file_path(name):
+    """ path in the temp directory for a file written in debug mode (not the working directory of the server) """
+    folder = os.path.join(tempfile.gettempdir(), 'labeldesigner-debug')
+    os.makedirs(folder, exist_ok = True)
+    return os.path.join(folder, name.replace(':', '_'))
 
-    lines = []
-    for line in text.split('\n'):
-        if line == '': line = ' '
-        lines.append(line)
-    text = '\n'.join(lines)
+def raster_backend():
+    """ True if labels are sent as native DYMO raster data instead of PDF (PRINTER.BACKEND "dymo_raster") """
+    return CONFIG['PRINTER'].get('BACKEND', 'pdf') == 'dymo_raster'
 
-    textsize = draw.multiline_textbbox(xy=(0,0),text=text, font=im_font)
-    width, height = kwargs['width'], kwargs['height']
-    im = Image.new('RGB', (width*10, height*10), 'white')
-    draw = ImageDraw.Draw(im)
-    
-    vertical_offset  = (height - textsize[1])//2
-    vertical_offset += (kwargs['margin_top'] - kwargs['margin_bottom'])//2
-    horizontal_offset = max((width - textsize[2])//2, 0)
-    horizontal_offset = kwargs['margin_left'] - kwargs['margin_right']
-    offset = horizontal_offset, vertical_offset
-    
-    draw_multiline_text(im, text, im_font, kwargs, offset)
+def vector_backend():
+    """ True if labels are sent as vector PDF with embedded font subsets (PRINTER.BACKEND "vector_pdf") """
+    return CONFIG['PRINTER'].get('BACKEND', 'pdf') == 'vector_pdf'
 
-    return im
+def raster_options():
+    """ (rotate, density, dot tab) of the DYMO raster output """
+    return (CONFIG['PRINTER'].get('RASTER_ROTATE', False),
+            CONFIG['PRINTER'].get('RASTER_DENSITY', 'normal'),
+            CONFIG['PRINTER'].get('RASTER_DOT_TAB', 0))
 
-def create_label_grocy(kwargs):
+def render_document(context, num_copies = 1):
     """
-    Erstellt ein Label mit Text und einem Code-128 Barcode.
-    
-    :param text_lines: Liste mit Textzeilen (max. 2 Zeilen)
-    :param barcode_data: Daten für den Code-128 Barcode
-    :param label_size_mm: Maße des Labels in Millimetern (Breite, Höhe)
-    :param dpi: Druckauflösung (dots per inch)
-    :return: PIL-Image des Labels
+    renders the print document of a label (PDF or DYMO raster data) in the render pool,
+    timing it as 'render' stage plus the stages of the renderer
     """
+    with span('render'):
+        if raster_backend():
+            document, render_spans = render_pool.run(collect_spans, render_label_raster, context, num_copies, *raster_options())
+        elif vector_backend():
+            document, render_spans = render_pool.run(collect_spans, render_label_vector_pdf, context, num_copies)
+        else:
+            document, render_spans = render_pool.run(collect_spans, render_label_pdf, context, num_copies)
+    add_spans(render_spans)
+    return document
 
-    barcode_data = kwargs['grocycode']
-    label_size_mm = (kwargs['width'],kwargs['height'])
-    dpi = kwargs['dpi']
-    
-    # Berechnung der Pixel basierend auf DPI
-    label_size_px = (int(label_size_mm[0] / 25.4 * dpi), int(label_size_mm[1] / 25.4 * dpi))
-    width, height = label_size_mm
-    
-    # Erstelle das Label-Bild
-    label_image = Image.new("RGB", label_size_px, "white")
-    draw = ImageDraw.Draw(label_image)
-
-    # Schriftart laden (Systemschrift oder Standardschrift)
+def print_file(data, job_name = "Barcode Designer"):
+    """
+    sends the print document `data` (bytes) to the configured printer and
+    returns the CUPS job id right away; the job is tracked by the job monitor.
+    DYMO raster data is sent as raw job, to CUPS or directly to a
+    file:// or tcp:// target (PRINTER.RASTER_TARGET) - then there's no job id.
+    """
+    target = CONFIG['PRINTER'].get('RASTER_TARGET', 'cups')
     try:
-        im_font = ImageFont.truetype(kwargs['font_path'], kwargs['font_size'])
-    except IOError:
-        im_font = ImageFont.load_default()
-    
-    textsize = draw.multiline_textbbox(xy=(0,0),text=kwargs['product'], font=im_font)
-    
-    vertical_offset  = (height - textsize[1])//2
-    vertical_offset += (kwargs['margin_top'] - kwargs['margin_bottom'])//2
-    horizontal_offset = max((width - textsize[2])//2, 0)
-    horizontal_offset = kwargs['margin_left'] - kwargs['margin_right']
-    offset = horizontal_offset, vertical_offset
-    
-    kwargs['topHalf'] = True
-    kwargs['distribute_vertically'] = True
-
-    draw_multiline_text(label_image, f"{kwargs['product']}\n{kwargs['due_date']}", im_font, kwargs, offset)
-
-    # Barcode hinzufügen
-    barcode_class = Code128(barcode_data, writer=ImageWriter())
-    barcode_options = {
-        "module_width": 0.4,  # Breite eines Moduls in mm
-        "module_height": 15,  # Höhe des Barcodes: 15 mm
-        "quiet_zone": 0,  # Abstand links und rechts
-        "font_size": 1,  # Keine Schrift unter dem Barcode
-        "text_distance": 0,  # Abstand zwischen Barcode und Text
-    }
-    barcode_img_buffer = BytesIO()
-    barcode_class.write(barcode_img_buffer, options=barcode_options)
-    barcode_img_buffer.seek(0)
-    
-
-    # Barcode als Bild laden und skalieren
-    barcode_pil_img = Image.open(barcode_img_buffer)
-    barcode_width, barcode_height = barcode_pil_img.size
-    
-    crop = 15
-    barcode_pil_img = barcode_pil_img.crop((0, crop, barcode_width, barcode_height-crop))
-    barcode_pil_img = barcode_pil_img.resize(
-        (label_size_px[0], label_size_px[1]//2),#int(barcode_height * scale_factor)),
-        Image.LANCZOS,  # Verwende direkt LANCZOS für die Skalierung
-    )
-    
-    if DEBUG: barcode_pil_img.save(f"{barcode_data}_barcode.png")
+        if raster_backend() and target != 'cups':
+            with span('send'):
+                send_raw(target, data)
+            return None
+        elif raster_backend():
+            options, document_format = {}, 'application/vnd.cups-raw'
+        else:
+            options, document_format = {'choice': 'auto-fit'}, 'application/pdf'
+        with span('cups'):
+            job_id = cups_pool.run(lambda cups_connection: print_bytes(cups_connection, CONFIG['PRINTER']['PRINTER'], data, job_name, options, document_format))
+    except Exception:
+        PRINT_JOBS.inc(state = 'submit_failed')
+        raise
+
+    logger.info(f"Monitoring Print Job ID: {job_id}")
+    job_monitor.add(job_id, job_name)
+    return job_id
+
+@get('/api/jobs')
+def get_jobs():
+    """
+    API endpoint listing the recently submitted print jobs and their state,
+    the jobs of the print queue are listed in 'queued'.
 
-    # Positioniere den Barcode unten auf dem Label
-    barcode_x = 0
-    barcode_y = label_size_px[1] - barcode_pil_img.size[1]
-    barcode_y += 15 if kwargs['width']==57 and kwargs['height']==32 else 0
-    label_image.paste(barcode_pil_img, (barcode_x, barcode_y))
+    returns: JSON
+    """
+    return {'success': True, 'jobs': job_monitor.jobs(), 'queued': [queued_job(job) for job in print_queue.jobs()],
+            'connections': cups_pool.stats(), 'queue': print_queue.stats()}
 
-    return label_image
+@get('/api/jobs/<job_id:int>')
+def get_job(job_id):
+    """
+    API endpoint reporting the state of a submitted print job
+    (pending, held, processing, stopped, canceled, aborted or completed).
 
-def image_to_pdf(label_image, output_file="label", num_copies = 1):
+    returns: JSON
     """
-    Speichert das Label als PDF.
+    job = job_monitor.get(job_id)
+    if job is None:
+        response.status = 404
+        return {'success': False, 'error': f"no job found with ID {job_id}"}
+    return {'success': True, 'job': job}
+
+@get('/api/jobs/<queue_id:re:q[0-9]+>')
+def get_queued_job(queue_id):
     """
-    if num_copies > 1:
-        tmp_file = "/tmp/label_temp.pdf"
-        label_image.save(tmp_file, "PDF")
-        
-        output = PdfWriter()
-        label = PdfReader(open(tmp_file, "rb"))
-        for _ in range(num_copies):
-            output.add_page(label.pages[0])
-        outputStream = open(f"{output_file}.pdf", "wb")
-        output.write(outputStream)
-        outputStream.close()
-        os.remove(tmp_file)
-        
-    else: label_image.save(f"{output_file}.pdf", "PDF")
+    API endpoint reporting the state of a job of the print queue (queued,
+    printing, printed or failed); once it has been sent to CUPS the state
+    of the CUPS job (see above) with its ID in 'job_id'.
 
-@get('/api/preview/text')
-@post('/api/preview/text')
-def get_preview_image():
-    context = get_label_context(request)
-    
-    if context['printGrocy']:
-        context = change_grocy_context(context)
-        im = create_label_grocy(context)
-        if DEBUG: 
-            print(context)
-            im.save(f"{context['grocycode']}.png", "png")
-        
-    else:
-        im = create_label_im(**context)
-        
-    return_format = request.query.get('return_format', 'png')
-    if return_format == 'base64':
-        import base64
-        response.set_header('Content-type', 'text/plain')
-        return base64.b64encode(image_to_png_bytes(im))
-    else:
-        response.set_header('Content-type', 'image/png')
-        return image_to_png_bytes(im)
-
-def image_to_png_bytes(im):
-    image_buffer = BytesIO()
-    im.save(image_buffer, format="PNG")
-    image_buffer.seek(0)
-    return image_buffer.read()
-
-def print_file(file, job_name = "Barcode Designer"):
-    cups_connection = cups.Connection()
-    job_id = cups_connection.printFile(CONFIG['PRINTER']['PRINTER'], file, job_name, {'choice': 'auto-fit'})
-
-    # Get the job status
-    job_info = cups_connection.getJobAttributes(job_id)
-
-    if job_info:
-        logger.info(f"Monitoring Print Job ID: {job_id}")
-        while True:
-            # Fetch the updated job info
-            job_info = cups_connection.getJobAttributes(job_id)
-
-            # Check if the job is still active
-            if job_info['job-state'] in [1, 3, 4]:  # 1: pending, 3: processing, 4: stopped
-                logger.info(f"Print Job ID: {job_id}, Status: {job_info['job-state-reasons']}")
-            elif job_info['job-state'] in [5, 9]: # 5: printing, 9: print finished
-                logger.info(f"Print Job ID: {job_id}, Final Status: {job_info['job-state-reasons']}")
-                break
-            else:
-                return_message = str(job_info['job-state-reasons'])
-                logger.warning(f'Print Job ID: {job_id}, ERROR Status {job_info['job-state-reasons']}')
-                break
-            
-            # Wait for a few seconds before checking again
-            time.sleep(2)
-    else:
-        return_message = f"Print Job: no job found with ID {job_id}"
-        logger.warning(f"Print Job: no job found with ID {job_id}")
-    
-    return_message = "Job ID: " + str(job_id)
-    del cups_connection
-    return return_message
+    returns: JSON
+    """
+    job = print_queue.get(queue_id)
+    if job is None:
+        response.status = 404
+        return {'success': False, 'error': f"no job found with ID {queue_id}"}
+    return {'success': True, 'job': queued_job(job)}
+
+def queued_job(job):
+    """ the print queue entry `job` with the state of its CUPS job, if it was sent to CUPS """
+    result = job.pop('result', None)
+    if isinstance(result, dict):  # a batch: the outcome of every label and the CUPS job id
+        job['labels'] = result['labels']
+        result = result['job_id']
+    if DEBUG and result is not None:
+        job['data'] = result
+    elif isinstance(result, int):
+        job['job_id'] = result
+        cups_job = job_monitor.get(result)
+        if cups_job is not None:
+            job.update({key: value for key, value in cups_job.items() if key not in ('id', 'submitted')})
+    return job
 
 @post('/api/print/grocy')
 @get('/api/print/grocy')
@@ -424,33 +598,65 @@ def print_grocy():
     try:
         context = get_label_context(request)
     except LookupError as e:
-        return_dict['error'] = e.msg
+        return_dict['error'] = str(e)
         return return_dict
 
     if context['product'] is None:
         return_dict['error'] = 'Please provide the product for the label'
         return return_dict
-    
+
+    # the webhook doesn't send printGrocy, its labels are always grocy labels
+    context['printGrocy'] = True
+
+    # Grocy fires the webhook again on double clicks and retries: the same
+    # grocycode and due date within DEDUP_WINDOW seconds is printed only once
+    key = (context['grocycode'], context['due_date'])
+    return queue_print_job(return_dict, key, f"{context['grocycode']}.pdf", print_grocy_label, context)
+
+def print_grocy_label(context):
+    """ renders and prints a grocy label, returns the CUPS job id (or the PDF file name in debug mode) """
     context = change_grocy_context(context)
-    
     if DEBUG: print(context)
-    
-    im = create_label_grocy(context)
-    image_to_pdf(im, context['grocycode'])    
-
-    if not DEBUG:
-        try:
-            return_dict['message'] = print_file(f"{context['grocycode']}.pdf", f"{context['grocycode']}.pdf")
-            os.remove(f"{context['grocycode']}.pdf")
-        except Exception as e:
-            return_dict['message'] = str(e)
-            logger.warning('Exception happened: %s', e)
-            return return_dict
+    document = render_document(context)
+    if DEBUG:
+        file_name = debug_file_path(f"{context['grocycode']}.{'bin' if raster_backend() else 'pdf'}")
+        with open(file_name, "wb") as fh: fh.write(document)
+        return file_name
+    return print_file(document, f"{context['grocycode']}.pdf")
+
+def queue_print_job(return_dict, key, name, func, *args):
+    """
+    queues func(*args) in the print queue and responds 202 with the queue id
+    right away, the state of the job is at /api/jobs/<queue id>;
+    responds 429 if the queue is full
+    """
+    route = request.environ['bottle.route'].rule
+    try:
+        job, duplicate = print_queue.submit(key, name, run_print_job, route, func, *args)
+    except QueueFull as e:
+        response.status = 429
+        response.set_header('Retry-After', '5')
+        return_dict['error'] = f'The print queue is full, please retry later ({e})'
+        return return_dict
 
+    response.status = 202
     return_dict['success'] = True
-    if DEBUG: return_dict['data'] = f"{context['grocycode']}.pdf"
+    return_dict['duplicate'] = duplicate
+    return_dict['job_id'] = job['id']
+    return_dict['message'] = f"Queued as job {job['id']}" + (" (duplicate of an earlier request)" if duplicate else "")
     return return_dict
 
+def run_print_job(route, func, *args):
+    """ runs a job of the print queue, its pipeline stage spans are recorded for the route that queued it """
+    try:
+        result, job_spans = collect_spans(func, *args)
+    except Exception as e:
+        logger.warning('Exception happened: %s', e)
+        raise
+    for stage, seconds in job_spans.items():
+        STAGE_SECONDS.observe(seconds, route = route, stage = stage)
+    return result
+
 @post('/api/print/text')
 @get('/api/print/text')
 def print_text():
@@ -459,38 +665,117 @@ def print_text():
     try:
         context = get_label_context(request)
     except LookupError as e:
-        return_dict['error'] = e.msg
+        return_dict['error'] = str(e)
         return return_dict
     
+    if not context['printGrocy'] and context['text'] is None:
+        return_dict['error'] = 'Please provide the text for the label'
+        return return_dict
+
+    return queue_print_job(return_dict, None, "Barcode Designer", print_text_label, context)
+
+def print_text_label(context):
+    """ renders and prints a label of the designer, returns the CUPS job id (None in debug mode) """
+    job_name = "Barcode Designer"
     if context['printGrocy']:
         context = change_grocy_context(context)
-        im = create_label_grocy(context)
-        image_to_pdf(im, context['grocycode'], context['numCopies'])
-        im = f"{context['grocycode']}.pdf"
-        
-    else:
-        if context['text'] is None:
-            return_dict['error'] = 'Please provide the text for the label'
-            return return_dict
-        
-        im = create_label_im(**context)
-        image_to_pdf(im, context['text'], context['numCopies'])
-        im = f"{context['text']}.pdf"
-    
-    if not DEBUG:
+        job_name = f"{context['grocycode']}.pdf"
+
+    document = render_document(context, context['numCopies'])
+
+    if DEBUG: return None
+    return print_file(document, job_name)
+
+def prepare_label_context(context):
+    """ resolves the grocy product of grocy labels; raises ValueError if a text label has no text """
+    if context['printGrocy']:
+        return change_grocy_context(context)
+    if context['text'] is None:
+        raise ValueError('Please provide the text for the label')
+    return context
+
+@post('/api/print/batch')
+def print_batch():
+    """
+    API endpoint printing many labels (text and grocy labels mixed) as a single print job.
+    The batch goes through the print queue like the other print requests; the outcome
+    of every label is reported with the job at /api/jobs/<queue id>.
+
+    expects: JSON {"defaults": {...}, "labels": [{...}, ...]} where every label
+             takes the same parameters as /api/print/text and overrides the defaults
+    returns: JSON
+    """
+    return_dict = {'success': False}
+
+    payload = request.json
+    if not isinstance(payload, dict) or not isinstance(payload.get('labels'), list) or not payload['labels']:
+        return_dict['error'] = 'Please provide a JSON object with a non-empty list of labels'
+        return return_dict
+    defaults = payload.get('defaults', {})
+    labels = [{**defaults, **label} if isinstance(label, dict) else label for label in payload['labels']]
+
+    def copies(label):
         try:
-            return_dict['message'] = print_file(im)
-            os.remove(im)
-        except (Exception, cups.IPPError) as e:
-            return_dict['message'] = str(e)
-            logger.warning('Exception happened: %s', e)
-            return return_dict
+            return max(int(label.get('numCopies', 1)), 1)
+        except (AttributeError, TypeError, ValueError):
+            return 1  # the label fails when it's rendered
+
+    max_pages = CONFIG['PRINTER'].get('BATCH_MAX_PAGES', 200)
+    pages = sum(copies(label) for label in labels)
+    if pages > max_pages:
+        response.status = 400
+        return_dict['error'] = f'The batch has {pages} pages (labels times copies), at most {max_pages} are printed at once'
+        return return_dict
 
-    return_dict['success'] = True
-    return return_dict
+    return queue_print_job(return_dict, None, "Label Batch", print_batch_labels, labels)
+
+def print_batch_labels(labels):
+    """
+    renders the labels of a batch and prints them as one document;
+    returns {'job_id': CUPS job id, 'labels': outcome of every label}
+    """
+    def render(label):
+        context = prepare_label_context(label_context_from_params(label))
+        if raster_backend(): context = raster_context(context)
+        if vector_backend():
+            return (render_pool.run(label_layout, context), context), context['numCopies']
+        return render_pool.run(render_label_image, context), context['numCopies']
+
+    workers = min(len(labels), CONFIG['SERVER'].get('RENDER_THREADS', 4))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render, label) for label in labels]
+
+    rendered = []
+    outcome = []
+    for index, future in enumerate(futures):
+        try:
+            im, num_copies = future.result()
+        except Exception as e:
+            logger.warning('Label %d of the batch failed: %s', index, e)
+            outcome.append({'index': index, 'success': False, 'error': str(e)})
+            continue
+        rendered.append((im, num_copies))
+        outcome.append({'index': index, 'success': True, 'copies': num_copies})
+
+    if not rendered:
+        raise ValueError(f"None of the labels could be rendered ({outcome[0]['error']})")
+
+    if raster_backend():
+        document = labels_to_raster(rendered, *raster_options())
+    elif vector_backend():
+        try:
+            document = layouts_to_vector_pdf([(layout, num_copies) for (layout, _), num_copies in rendered])
+        except ValueError as e:
+            logger.warning('Falling back to a raster PDF: %s', e)
+            document = images_to_pdf_bytes([(render_pool.run(render_label_image, context), num_copies)
+                                            for (_, context), num_copies in rendered])
+    else:
+        document = images_to_pdf_bytes(rendered)
+
+    return {'job_id': None if DEBUG else print_file(document, "Label Batch"), 'labels': outcome}
 
 def main():
-    global DEBUG, FONTS, BACKEND_CLASS, CONFIG
+    global DEBUG, FONTS, BACKEND_CLASS, CONFIG, render_pool
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--port', default=False)
     parser.add_argument('--loglevel', type=lambda x: getattr(logging, x.upper()), default=False)
@@ -505,6 +790,12 @@ def main():
     if args.printer:
         CONFIG['PRINTER']['PRINTER'] = args.printer
 
+    if args.grocy:
+        CONFIG['GROCY']['URI'] = args.grocy
+
+    if args.api:
+        CONFIG['GROCY']['API_KEY'] = args.api
+
     if args.port:
         PORT = args.port
     else:
@@ -533,14 +824,28 @@ def main():
         
     logging.basicConfig(level=LOGLEVEL)
 
-    FONTS = get_fonts()
+    font_folders = CONFIG['SERVER'].get('FONT_FOLDERS') or FONT_DIRS
     if ADDITIONAL_FONT_FOLDER:
-        FONTS.update(get_fonts(ADDITIONAL_FONT_FOLDER))
+        font_folders = font_folders + [ADDITIONAL_FONT_FOLDER]
+    font_index = FontIndex(CONFIG['SERVER'].get('FONT_INDEX', 'font_index.json'), font_folders)
+    font_index.load()
+    updated, removed = font_index.refresh()
+    logger.debug('Font index: %d files, %d (re)read, %d removed', len(font_index.files), updated, removed)
+    FONTS = font_index.fonts()
+
+    if not FONTS:
+        # fonts configured in fontconfig outside of the indexed folders
+        FONTS = get_fonts()
+        if ADDITIONAL_FONT_FOLDER:
+            FONTS.update(get_fonts(ADDITIONAL_FONT_FOLDER))
 
     if not FONTS:
         sys.stderr.write("Not a single font was found on your system. Please install some or use the \"--font-folder\" argument.\n")
         sys.exit(2)
 
+    default_font_paths = [FONTS[font['family']][font['style']] for font in CONFIG['LABEL']['DEFAULT_FONTS']
+                          if font['style'] in FONTS.get(font['family'], {})]
+
     for font in CONFIG['LABEL']['DEFAULT_FONTS']:
         try:
             FONTS[font['family']][font['style']]
@@ -555,7 +860,22 @@ def main():
         CONFIG['LABEL']['DEFAULT_FONTS'] = {'family': family, 'style': style}
         sys.stderr.write('The default font is now set to: {family} ({style})\n'.format(**CONFIG['LABEL']['DEFAULT_FONTS']))
 
-    run(host=CONFIG['SERVER']['HOST'], port=PORT, debug=DEBUG)
+    render_pool = RenderPool(CONFIG['SERVER'].get('RENDER_PROCESSES', 0),
+                             font_paths = default_font_paths,
+                             font_sizes = [CONFIG['LABEL']['DEFAULT_FONT_SIZE']])
+
+    # fonts, render workers and Grocy are warmed up while the server already accepts requests
+    threading.Thread(target=warm_up, args=(default_font_paths, [CONFIG['LABEL']['DEFAULT_FONT_SIZE']]),
+                     name='warm-up', daemon=True).start()
+
+    server = CONFIG['SERVER'].get('SERVER', 'threaded')
+    server_options = {}
+    if server in ('threaded', 'waitress'):
+        server_options['threads'] = CONFIG['SERVER'].get('THREADS', 8)
+    if server == 'threaded':
+        server_options['queued_requests'] = CONFIG['SERVER'].get('QUEUED_REQUESTS', 8)
+
+    run(server=get_server(server), host=CONFIG['SERVER']['HOST'], port=PORT, debug=DEBUG, **server_options)
     
 if __name__ == "__main__":
     main()
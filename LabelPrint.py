@@ -1,10 +1,19 @@
+import argparse, csv, json, logging, os, sys
+from collections import deque
+
 from PIL import Image, ImageDraw, ImageFont
 from barcode import Code128
 from barcode.writer import ImageWriter
-from io import BytesIO
-from PyPDF2 import PdfReader, PdfWriter
-import cups
-import os
+from io import BytesIO, TextIOWrapper
+
+from font_helpers import get_font
+from pdf_helpers import image_to_pdf_bytes, image_objects, image_page, PDFStreamWriter
+from label_helpers import RenderPool
+from cups_helpers import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+CUPS_POOL = ConnectionPool(size=1)
 
 def create_label(text_lines, barcode_data, label_size_mm=(57, 32), dpi=300):
     """
@@ -27,7 +36,7 @@ def create_label(text_lines, barcode_data, label_size_mm=(57, 32), dpi=300):
     # Schriftart laden (Systemschrift oder Standardschrift)
     try:
         font_size = int(desired_font_height_mm / 25.4 * dpi)  # Schriftgröße: 8 mm (entspricht ~22.7 pt bei 300 DPI)
-        font = ImageFont.truetype("/usr/share/fonts/truetype/bahnschrift/BAHNSCHRIFT.TTF", font_size)
+        font = get_font("/usr/share/fonts/truetype/bahnschrift/BAHNSCHRIFT.TTF", font_size)
     except IOError:
         font = ImageFont.load_default()
 
@@ -75,29 +84,205 @@ def save_as_pdf(label_image, output_file="label", num_copies = 1):
     """
     Speichert das Label als PDF.
     """
-    if num_copies > 1:
-        tmp_file = "/tmp/label_temp.pdf"
-        label_image.save(tmp_file, "PDF")
-        
-        output = PdfWriter()
-        label = PdfReader(open(tmp_file, "rb"))
-        for _ in range(num_copies):
-            output.add_page(label.pages[0])
-        outputStream = open(f"{output_file}.pdf", "wb")
-        output.write(outputStream)
-        outputStream.close()
-        os.remove(tmp_file)
-        
-    else: label_image.save(f"{output_file}.pdf", "PDF")
+    with open(f"{output_file}.pdf", "wb") as fh:
+        fh.write(image_to_pdf_bytes(label_image, num_copies))
 
 
 def print_label(printer_name, output_file="label.pdf"):
     """Druckt das Label mit CUPS."""
-    cups_connection = cups.Connection()
-    cups_connection.printFile(printer_name, f"{output_file}.pdf", "DYMO Label", {'choice': 'auto-fit'})
+    CUPS_POOL.run(lambda cups_connection: cups_connection.printFile(printer_name, f"{output_file}.pdf", "DYMO Label", {'choice': 'auto-fit'}))
+
+
+def parse_row(row):
+    """
+    Liest Text, Barcode und Anzahl Kopien aus einer Eingabezeile.
+
+    :param row: dict mit `barcode`, optional `copies` und dem Text entweder als
+                `text_lines` (Liste), `text` (Zeilen durch Zeilenumbrüche getrennt)
+                oder in den Spalten `line1`, `line2`, ...
+    :return: (Textzeilen, Barcode-Daten, Anzahl Kopien)
+    """
+    if not isinstance(row, dict):
+        raise ValueError('expected an object with text, barcode and copies')
+    if isinstance(row.get('text_lines'), list):
+        text_lines = [str(line) for line in row['text_lines']]
+    elif row.get('text') is not None:
+        text_lines = str(row['text']).split('\n')
+    else:
+        columns = sorted((key for key in row if key and key.startswith('line') and key[4:].isdigit()), key=lambda key: int(key[4:]))
+        text_lines = ['' if row[key] is None else str(row[key]) for key in columns]
+    barcode_data = str(row.get('barcode') or '').strip()
+    if not barcode_data:
+        raise ValueError('barcode is missing')
+    try:
+        num_copies = int(row.get('copies') or 1)
+    except (TypeError, ValueError):
+        raise ValueError(f"copies must be a number, not {row.get('copies')!r}")
+    if num_copies < 1:
+        raise ValueError('copies must be at least 1')
+    return text_lines, barcode_data, num_copies
+
+
+def read_rows(fh, fmt):
+    """ Liest die Zeilen einer CSV-Datei (mit Kopfzeile) oder JSON-Lines-Datei als (Zeilennummer, Zeile oder ValueError) """
+    if fmt == 'csv':
+        reader = csv.DictReader(fh)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(fh, start=1):
+            if not line.strip(): continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f'invalid JSON: {e}')
+
+
+def render_page_objects(text_lines, barcode_data, label_size_mm, dpi):
+    """
+    Erstellt ein Label im Worker-Prozess und gibt seine PDF-Objekte zurück (siehe pdf_helpers.image_objects()).
+    Die Seitengröße ist wie bei save_as_pdf() ein Punkt pro Pixel, CUPS skaliert auf das Label.
+    """
+    return image_objects(create_label(text_lines, barcode_data, label_size_mm, dpi))
+
+
+def render_rows(rows, pool, label_size_mm=(57, 32), dpi=300, window=16):
+    """
+    Erstellt die Labels der (Zeilennummer, Zeile)-Paare im Worker-Pool und liefert
+    (Zeilennummer, (PDF-Objekte, Kopien) oder den Fehler) in der Reihenfolge der Eingabe.
+    Höchstens `window` Labels sind gleichzeitig in Arbeit oder warten aufs Schreiben,
+    der Speicherbedarf wächst also nicht mit der Anzahl der Zeilen.
+    """
+    pending = deque()
+    for line_number, row in rows:
+        try:
+            if isinstance(row, Exception): raise row
+            text_lines, barcode_data, num_copies = parse_row(row)
+            pending.append((line_number, num_copies, pool.submit(render_page_objects, text_lines, barcode_data, label_size_mm, dpi)))
+        except (TypeError, ValueError) as e:
+            pending.append((line_number, 0, e))
+        while len(pending) >= window:
+            yield rendered(*pending.popleft())
+    while pending:
+        yield rendered(*pending.popleft())
+
+
+def rendered(line_number, num_copies, future):
+    if isinstance(future, Exception):
+        return line_number, future
+    try:
+        return line_number, (future.result(), num_copies)
+    except Exception as e:
+        return line_number, e
+
+
+class RollingPDFWriter:
+    """
+    Schreibt die Labels nacheinander in die PDF-Dateien `<output>-001.pdf`,
+    `<output>-002.pdf`, ... mit je höchstens `max_pages` Seiten (ohne Limit
+    in `<output>.pdf`). Das Bild eines Labels steht einmal pro Datei darin,
+    die Kopien sind Seiten, die darauf verweisen.
+    """
+
+    def __init__(self, output, max_pages=None):
+        self.output = output
+        self.max_pages = max_pages
+        self.files = []
+        self.pages = 0
+        self._fh = self._writer = None
+
+    def _next_file(self):
+        self.close()
+        name = f'{self.output}-{len(self.files) + 1:03d}.pdf' if self.max_pages else f'{self.output}.pdf'
+        self._fh = open(name, 'wb')
+        self._writer = PDFStreamWriter(self._fh)
+        self.files.append(name)
+
+    def add_label(self, page_objects, num_copies=1):
+        image, content, page_size = page_objects
+        refs = None
+        for _ in range(num_copies):
+            if self._writer is None or (self.max_pages and len(self._writer.pages) >= self.max_pages):
+                self._next_file()
+                refs = None
+            if refs is None:
+                refs = self._writer.add(image), self._writer.add(content)
+            self._writer.add_page(image_page(page_size, *refs))
+            self.pages += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._fh.close()
+            self._writer = self._fh = None
+
+
+def bulk(input_file, output, fmt=None, max_pages=None, workers=None, label_size_mm=(57, 32), dpi=300):
+    """
+    Erstellt die Labels einer CSV- oder JSON-Lines-Datei ('-' für stdin) als PDF-Dateien.
+    Ungültige Zeilen werden gemeldet und übersprungen.
+
+    :return: (geschriebene Dateien, Anzahl Seiten, Anzahl übersprungener Zeilen)
+    """
+    if fmt is None:
+        fmt = 'jsonl' if input_file.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if input_file == '-':
+        fh = TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    else:
+        fh = open(input_file, encoding='utf-8-sig', newline='')
+
+    pool = RenderPool(processes=workers)
+    writer = RollingPDFWriter(output, max_pages)
+    skipped = 0
+    try:
+        for line_number, result in render_rows(read_rows(fh, fmt), pool, label_size_mm, dpi, window=max(workers, 1) * 4):
+            if isinstance(result, Exception):
+                logger.warning('Zeile %d von %s übersprungen: %s', line_number, input_file, result)
+                skipped += 1
+                continue
+            writer.add_label(*result)
+    finally:
+        writer.close()
+        pool.shutdown()
+        if input_file != '-': fh.close()
+    return writer.files, writer.pages, skipped
+
+
+def label_size(value):
+    try:
+        width, height = (float(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid label size {value!r}, expected e.g. 57x32')
+    return width, height
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Erstellt Labels mit Text und Code-128 Barcode als PDF.')
+    parser.add_argument('input', nargs='?',
+                        help="CSV- oder JSON-Lines-Datei mit den Labels, '-' für stdin (ohne: das Beispiel-Label)")
+    parser.add_argument('-o', '--output', default='labels', help='Name der PDF-Dateien ohne .pdf (Standard: labels)')
+    parser.add_argument('-f', '--format', choices=('csv', 'jsonl'), help='Eingabeformat (Standard: nach Dateiendung, sonst csv)')
+    parser.add_argument('-n', '--max-pages', type=int, help='nach so vielen Seiten eine neue PDF-Datei beginnen')
+    parser.add_argument('-j', '--workers', type=int, help='Anzahl Worker-Prozesse (Standard: Anzahl CPUs, 0: im Hauptprozess)')
+    parser.add_argument('--size', type=label_size, default=(57, 32), help='Labelgröße in mm (Standard: 57x32)')
+    parser.add_argument('--dpi', type=int, default=300, help='Druckauflösung (Standard: 300)')
+    args = parser.parse_args()
+
+    if args.input is None:
+        example()
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    files, pages, skipped = bulk(args.input, args.output, args.format, args.max_pages, args.workers, args.size, args.dpi)
+    print(f"{pages} Seiten gespeichert in {', '.join(files) or 'keiner Datei'}")
+    if skipped:
+        print(f'{skipped} Zeile(n) übersprungen')
+        sys.exit(1)
+
+
+def example():
     # Benutzerdefinierte Daten
     text_lines = ["Ofengemüse", "(29.12.2024)"]
     barcode_data = "grcy:p:93"
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import logging
+from io import BytesIO
+
+from PIL import Image
+from barcode import Code128
+from barcode.writer import ImageWriter
+
+from cache_helpers import LRUCache
+
+logger = logging.getLogger(__name__)
+
+BARCODE_CACHE = LRUCache(maxsize=256)
+
+def code128_pattern(data):
+    """ Return the Code128 module pattern of `data` as string of '1' (bar) and '0' (space) """
+    return Code128(data).build()[0]
+
+def render_code128(data, size):
+    """
+    Render a Code128 barcode directly at the target pixel size.
+
+    Every module gets the same integer number of pixels, so the bars are sharp
+    and exactly equally wide. The barcode is centered horizontally if the
+    modules don't fill the whole width. If the width has less than a pixel
+    per module, the barcode is rendered with ImageWriter instead (see
+    render_code128_imagewriter()), scaling the bars down would drop modules.
+    """
+    width, height = size
+    pattern = code128_pattern(data)
+    if width < len(pattern):
+        logger.warning('The barcode %r has %d modules but only %d px, it may not be readable', data, len(pattern), width)
+        return render_code128_imagewriter(data, size)
+    module_px = width // len(pattern)
+
+    row = bytearray()
+    black, white = b'\x00' * module_px, b'\xff' * module_px
+    for module in pattern:
+        row += black if module == '1' else white
+
+    bars = Image.frombytes('L', (len(row), 1), bytes(row)).resize((len(row), height), Image.NEAREST)
+
+    barcode_img = Image.new('L', size, 'white')
+    barcode_img.paste(bars, ((width - bars.size[0]) // 2, 0))
+    return barcode_img
+
+def code128_bars(data, width):
+    """
+    Return the bars of the Code128 barcode of `data` as list of (x, width)
+    in pixels, with the same geometry as render_code128() draws them.
+    """
+    pattern = code128_pattern(data)
+    module_px = max(width // len(pattern), 1)
+    if module_px * len(pattern) > width:
+        module_px = width / len(pattern)
+    x0 = (width - module_px * len(pattern)) // 2
+
+    bars, start = [], None
+    for i, module in enumerate(pattern + '0'):
+        if module == '1' and start is None:
+            start = i
+        elif module == '0' and start is not None:
+            bars.append((x0 + start * module_px, (i - start) * module_px))
+            start = None
+    return bars
+
+def render_code128_imagewriter(data, size):
+    """
+    Render a Code128 barcode through python-barcode's ImageWriter and
+    scale it to the target pixel size (the previous, slower rendering path).
+    """
+    barcode_class = Code128(data, writer=ImageWriter())
+    barcode_options = {
+        "module_width": 0.4,  # Breite eines Moduls in mm
+        "module_height": 15,  # Höhe des Barcodes: 15 mm
+        "quiet_zone": 0,  # Abstand links und rechts
+        "font_size": 1,  # Keine Schrift unter dem Barcode
+        "text_distance": 0,  # Abstand zwischen Barcode und Text
+    }
+    barcode_img_buffer = BytesIO()
+    barcode_class.write(barcode_img_buffer, options=barcode_options)
+    barcode_img_buffer.seek(0)
+
+    barcode_pil_img = Image.open(barcode_img_buffer)
+    barcode_width, barcode_height = barcode_pil_img.size
+
+    crop = 15
+    barcode_pil_img = barcode_pil_img.crop((0, crop, barcode_width, barcode_height-crop))
+    return barcode_pil_img.resize(size, Image.LANCZOS)
+
+def get_barcode_image(data, size, dpi, fast=True):
+    """
+    Return the rendered Code128 barcode for `data` at `size` pixels.
+    Rendered barcodes are cached by (data, size, dpi), so reprinting
+    the same grocycode doesn't render the barcode again.
+    The returned image is shared - copy it before modifying it.
+    """
+    render = render_code128 if fast else render_code128_imagewriter
+    return BARCODE_CACHE.get_or_create((data, tuple(size), dpi, fast), lambda: render(data, tuple(size)))
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the label rendering and printing pipeline.
+
+Grocy and CUPS are replaced by in-process stubs, so nothing is printed and
+the numbers only depend on this machine. Every benchmark is run a few times
+to warm the caches, then timed `--repeat` times; the latency percentiles and
+the peak memory allocated during one run (tracemalloc) are reported.
+
+    python benchmark.py                            # run everything
+    python benchmark.py --filter grocy             # only benchmarks containing "grocy"
+    python benchmark.py --json baseline.json       # save the results
+    python benchmark.py --compare baseline.json    # exit code 1 if a p50 got slower than --threshold
+"""
+
+import sys, types, io, os, json, time, shutil, argparse, tempfile, statistics, threading, tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+# ---------------------------------------------------------------- stubs
+
+class StubCupsConnection:
+    """ stands in for cups.Connection: accepts every job and reports it as completed """
+
+    next_job_id = 1
+
+    def getDefault(self):
+        return 'Stub_Printer'
+
+    def createJob(self, printer, title, options):
+        job_id = StubCupsConnection.next_job_id
+        StubCupsConnection.next_job_id += 1
+        return job_id
+
+    def startDocument(self, printer, job_id, title, document_format, last_document):
+        pass
+
+    def writeRequestData(self, data, length):
+        return 100  # HTTP_CONTINUE
+
+    def finishDocument(self, printer):
+        pass
+
+    def printFile(self, printer, filename, title, options):
+        return self.createJob(printer, title, options)
+
+    def getJobAttributes(self, job_id):
+        return {'job-state': 9, 'job-state-reasons': 'job-completed-successfully'}
+
+def install_cups_stub():
+    cups = types.ModuleType('cups')
+    cups.IPPError = type('IPPError', (Exception,), {})
+    cups.HTTPError = type('HTTPError', (Exception,), {})
+    cups.HTTP_CONTINUE = 100
+    cups.Connection = StubCupsConnection
+    sys.modules['cups'] = cups
+
+class StubGrocyProduct:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+class StubGrocy:
+    """ stands in for pygrocy.Grocy with a fixed catalog of `count` products """
+
+    def __init__(self, count=500):
+        self.names = {i: f'Produkt Nummer {i} mit etwas längerem Namen' for i in range(1, count + 1)}
+        self.delay = 0  # seconds a product lookup takes, like a slow Grocy server
+
+    def product_by_barcode(self, barcode):
+        time.sleep(self.delay)
+        product_id = int(barcode.rpartition(':')[2])
+        return StubGrocyProduct(product_id, self.names[product_id]) if product_id in self.names else None
+
+    def get_userfields(self, entity, object_id):
+        return {'kurzname': f'Produkt {object_id}'}
+
+    def get_last_db_changed(self):
+        return '2024-12-29 12:00:00'
+
+    def get_generic_objects_for_type(self, entity_type):
+        if 'barcode' in str(entity_type).lower():
+            return [{'product_id': i, 'barcode': f'40000{i:05d}'} for i in self.names]
+        return [{'id': i, 'name': name, 'userfields': self.get_userfields('products', i)} for i, name in self.names.items()]
+
+install_cups_stub()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image, ImageDraw
+
+from font_helpers import FONT_DIRS, FontIndex, get_font, get_fonts
+from label_helpers import create_label_im, create_label_grocy, render_label_png, render_label_pdf, render_label_raster, render_label_vector_pdf, label_layout
+from text_helpers import METRICS_CACHE, draw_multiline_text, layout_lines, tokenize
+from pdf_helpers import image_to_pdf_bytes, images_to_pdf_bytes
+from vector_pdf_helpers import layouts_to_vector_pdf
+from grocy_helpers import ProductCatalog, ProductLookup
+
+LABEL_SIZES = [(57, 32), (54, 25)]
+TEXTS = {
+    'short': 'Ofengemüse',
+    'long':  'Ofengemüse mit Kartoffeln, Paprika und Zucchini vom Wochenmarkt (vegetarisch)',
+}
+# six paragraphs (114 words) for comparing the line breaking with the per-line measuring it replaced
+PARAGRAPHS = '\n\n'.join([
+    'Ofengemüse mit Kartoffeln, Paprika, Zucchini und roten Zwiebeln vom Wochenmarkt, dazu Rosmarin, Thymian und ein Schuss Olivenöl (vegetarisch).',
+    'Im vorgeheizten Ofen bei 200 Grad etwa vierzig Minuten garen und zwischendurch einmal wenden, damit alles gleichmäßig bräunt.',
+    'Hält sich im Kühlschrank in einer geschlossenen Dose drei bis vier Tage, eingefroren etwa drei Monate (am Vortag auftauen).',
+    'Zum Aufwärmen im Ofen oder in der Pfanne erhitzen, in der Mikrowelle werden die Kartoffeln weich und verlieren ihre Kruste.',
+    'Passt gut zu Quark mit Kräutern, zu gebratenem Halloumi oder als Füllung für Wraps mit etwas Joghurtsoße und frischem Salat.',
+    'Reste lassen sich pürieren und mit Gemüsebrühe zu einer Suppe verlängern, die mit geröstetem Brot und Kernen serviert wird.',
+])
+
+def layout_lines_per_line(text, font, width):
+    """ the line breaking before text_helpers.layout_lines(): every growing line is measured again, then every line twice more """
+    draw = ImageDraw.Draw(Image.new('L', (1, 1)))
+    lines, line = [], []
+    for token in tokenize(text):
+        if draw.textbbox((0, 0), text=' '.join(line + [token]), font=font)[2] <= width:
+            line.append(token)
+        else:
+            lines.append(' '.join(line))
+            line = [token]
+    if line:
+        lines.append(' '.join(line))
+    heights = [draw.textbbox((0, 0), text=line, font=font)[3] for line in lines]
+    widths = [draw.textbbox((0, 0), text=line, font=font)[2] for line in lines]
+    return list(zip(lines, widths, heights))
+
+# a grocy label template with static fields (see template_helpers)
+TEMPLATE = {'fields': [
+    {'type': 'text',    'value': 'Vorrat', 'box': [1, 1, 20, 4], 'font_size': 30, 'align': 'left'},
+    {'type': 'rect',    'box': [0, 5.5, 50, 0.3]},
+    {'type': 'text',    'value': '{product}\n{due_date}', 'box': [0, 6, 50, 10], 'distribute_vertically': True},
+    {'type': 'barcode', 'value': '{grocycode}', 'box': [2, 16.5, 46, 8]},
+]}
+
+def find_font(config):
+    """ returns (family, style, path) of the first configured default font, or of any font """
+    fonts = FontIndex(None, FONT_DIRS)
+    fonts.refresh()
+    fonts = fonts.fonts()
+    for font in config['LABEL']['DEFAULT_FONTS']:
+        if font['style'] in fonts.get(font['family'], {}):
+            return font['family'], font['style'], fonts[font['family']][font['style']]
+    for family in sorted(fonts):
+        for style in sorted(fonts[family]):
+            return family, style, fonts[family][style]
+    sys.exit('No font found, the benchmarks need at least one .ttf/.otf font')
+
+def label_context(font_path, **kwargs):
+    """ a label context as built by LabelDesigner.label_context_from_params() """
+    context = {
+        'text': TEXTS['short'], 'numCopies': 1, 'printGrocy': False, 'grocycode': 'grcy:p:93',
+        'product': 'Ofengemüse', 'print_alias': False, 'due_date': '(2024-12-29)',
+        'print_due_date': True, 'print_today': False, 'print_date': True, 'alias_userfield': 'kurzname',
+        'width': 57, 'height': 32, 'dpi': 300, 'font_path': font_path, 'font_size': 40,
+        'margin_top': 0.0, 'margin_bottom': 0.0, 'margin_left': 0.0, 'margin_right': 0.0,
+        'line_spacing': 8.0, 'align': 'center', 'vertical_align': 'top', 'topHalf': False,
+        'distribute_vertically': False, 'auto_fit': False, 'fill_color': 'black', 'mode': '1',
+        'fast_barcode': True, 'debug': False,
+    }
+    context.update(kwargs)
+    return context
+
+def call_wsgi(app, path, form=None, json_body=None):
+    """ POSTs form data or a JSON body to the bottle app like a HTTP client would; returns the response body """
+    if json_body is not None:
+        body, content_type = json.dumps(json_body).encode('utf-8'), 'application/json'
+    else:
+        body, content_type = urlencode(form or {}).encode('utf-8'), 'application/x-www-form-urlencoded'
+    environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80', 'wsgi.url_scheme': 'http', 'wsgi.errors': sys.stderr,
+               'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    response = []
+    result = b''.join(app(environ, lambda status, headers, exc_info=None: response.append((status, dict(headers)))))
+    status, headers = response[0]
+    if status[:3] not in ('200', '202') or ('json' in headers.get('Content-Type', '') and not json.loads(result)['success']):
+        raise RuntimeError(f'{path} failed with {status}: {result[:200]!r}')
+    return result
+
+# ---------------------------------------------------------------- benchmarks
+
+def rendering_benchmarks(font_path):
+    benchmarks = {}
+    for width, height in LABEL_SIZES:
+        size = f'{width}x{height}'
+        for length, text in TEXTS.items():
+            context = label_context(font_path, width=width, height=height, text=text)
+            def draw(context=context):
+                im = Image.new('L', (context['width'] * 10, context['height'] * 10), 'white')
+                draw_multiline_text(im, context['text'], get_font(context['font_path'], context['font_size']), context, (0, 0))
+            benchmarks[f'draw_multiline_text[{size}-{length}]'] = draw
+            benchmarks[f'create_label_im[{size}-{length}]'] = lambda context=context: create_label_im(**context)
+        context = label_context(font_path, width=width, height=height, text=TEXTS['long'], font_size=70, auto_fit=True)
+        benchmarks[f'create_label_im[{size}-long-auto_fit]'] = lambda context=context: create_label_im(**context)
+        context = label_context(font_path, width=width, height=height, printGrocy=True)
+        benchmarks[f'create_label_grocy[{size}]'] = lambda context=context: create_label_grocy(dict(context))
+        context = label_context(font_path, width=width, height=height, printGrocy=True, template=TEMPLATE)
+        benchmarks[f'create_label_grocy[{size}-template]'] = lambda context=context: create_label_grocy(dict(context))
+        context = label_context(font_path, width=width, height=height, printGrocy=True, scale=0.5)
+        benchmarks[f'preview_png[{size}-scale0.5]'] = lambda context=context: render_label_png(context)
+        context = label_context(font_path, width=width, height=height, printGrocy=True)
+        benchmarks[f'render_label_pdf[{size}]'] = lambda context=context: render_label_pdf(context)
+        benchmarks[f'render_label_raster[{size}]'] = lambda context=context: render_label_raster(context)
+        benchmarks[f'render_label_vector_pdf[{size}]'] = lambda context=context: render_label_vector_pdf(context)
+
+    image = create_label_grocy(label_context(font_path, printGrocy=True))
+    for copies in (1, 10, 100):
+        benchmarks[f'image_to_pdf_bytes[copies={copies}]'] = lambda copies=copies: image_to_pdf_bytes(image, copies, 300)
+    labels = [(image, 1)] * 20
+    benchmarks['images_to_pdf_bytes[20 labels]'] = lambda: images_to_pdf_bytes(labels, 300)
+    layout = label_layout(label_context(font_path, printGrocy=True))
+    for copies in (1, 10, 100):
+        benchmarks[f'layouts_to_vector_pdf[copies={copies}]'] = lambda copies=copies: layouts_to_vector_pdf([(layout, copies)])
+    layouts = [(layout, 1)] * 20
+    benchmarks['layouts_to_vector_pdf[20 labels]'] = lambda: layouts_to_vector_pdf(layouts)
+    return benchmarks
+
+def text_layout_benchmarks(font_path):
+    """ line breaking of several paragraphs: per token (cached metrics and cold) against measuring every line """
+    font, width = get_font(font_path, 20), 1140
+    if [line for line, _, _ in layout_lines(PARAGRAPHS, font, width)] != [line for line, _, _ in layout_lines_per_line(PARAGRAPHS, font, width)]:
+        raise RuntimeError('layout_lines() breaks the paragraphs differently than the per-line measuring')
+    def cold():
+        METRICS_CACHE.invalidate()
+        layout_lines(PARAGRAPHS, font, width)
+    return {'layout_lines[paragraphs-per line]':       lambda: layout_lines_per_line(PARAGRAPHS, font, width),
+            'layout_lines[paragraphs-per token-cold]': cold,
+            'layout_lines[paragraphs-per token]':      lambda: layout_lines(PARAGRAPHS, font, width)}
+
+def font_benchmarks(output_dir):
+    """ font discovery at startup: the font index, built from scratch and up to date, against the fc-list scan """
+    index_path = os.path.join(output_dir, 'font_index.json')
+
+    def font_index(rebuild):
+        if rebuild and os.path.exists(index_path): os.remove(index_path)
+        index = FontIndex(index_path, FONT_DIRS)
+        index.load()
+        index.refresh()
+        return index.fonts()
+
+    benchmarks = {'FontIndex[cold]': lambda: font_index(True),
+                  'FontIndex[warm]': lambda: font_index(False)}
+    if shutil.which('fc-list'):
+        benchmarks['get_fonts[fc-list]'] = get_fonts
+    else:
+        print('fc-list not found, skipping get_fonts[fc-list]', file=sys.stderr)
+    return benchmarks
+
+def labelprint_benchmarks(output_dir):
+    import LabelPrint
+    image = LabelPrint.create_label(['Ofengemüse', '(29.12.2024)'], 'grcy:p:93')
+    benchmarks = {'LabelPrint.create_label': lambda: LabelPrint.create_label(['Ofengemüse', '(29.12.2024)'], 'grcy:p:93')}
+    for copies in (1, 10):
+        output = os.path.join(output_dir, f'label-{copies}')
+        benchmarks[f'LabelPrint.save_as_pdf[copies={copies}]'] = lambda output=output, copies=copies: LabelPrint.save_as_pdf(image, output, copies)
+    rows = os.path.join(output_dir, 'rows.jsonl')
+    with open(rows, 'w', encoding='utf-8') as fh:
+        for i in range(20):
+            fh.write(json.dumps({'text_lines': [f'Regal {i}', 'Ofengemüse'], 'barcode': f'grcy:p:{i}', 'copies': 2}) + '\n')
+    output = os.path.join(output_dir, 'bulk')
+    benchmarks['LabelPrint.bulk[20 rows]'] = lambda: LabelPrint.bulk(rows, output, max_pages=16, workers=0)
+    return benchmarks
+
+def endpoint_benchmarks(font):
+    import bottle
+    import LabelDesigner as designer
+
+    family, style, path = font
+    designer.FONTS = {family: {style: path}}
+    designer.CONFIG['LABEL']['DEFAULT_FONTS'] = {'family': family, 'style': style}
+    designer.CONFIG['GROCY']['ENABLE'] = True
+    stub = StubGrocy()
+    designer.product_lookup = ProductLookup(stub)
+    designer.product_catalog = ProductCatalog(stub)
+    designer.grocy = stub
+    app = bottle.default_app()
+
+    font_family = f'{family} ({style})'
+    text_label = {'text': TEXTS['short'], 'font_family': font_family, 'font_size': 40, 'label_size': '57x32'}
+    grocy_label = {'grocycode': 'grcy:p:93', 'product': 'Ofengemüse', 'due_date': '2024-12-29',  # as sent by the Grocy webhook
+                   'print_alias': 'true', 'font_family': font_family, 'font_size': 40, 'label_size': '57x32'}
+    counter = iter(range(10**9))
+
+    def print_label(path, form=None, json_body=None):
+        # the print endpoints answer 202 once the job is queued, time it until it was printed
+        job = designer.print_queue.wait(json.loads(call_wsgi(app, path, form, json_body))['job_id'])
+        if job['state'] == 'failed':
+            raise RuntimeError(f"{path} failed: {job['error']}")
+
+    benchmarks = {
+        # a new text every time, so the preview cache doesn't answer
+        'POST /api/preview/text[uncached]': lambda: call_wsgi(app, '/api/preview/text', dict(text_label, text=f'Ofengemüse {next(counter)}')),
+        'POST /api/preview/text[cached]':   lambda: call_wsgi(app, '/api/preview/text', text_label),
+        # a new due date every time, repeated webhooks are dropped as duplicates
+        'POST /api/print/grocy':            lambda: print_label('/api/print/grocy', dict(grocy_label, due_date=f'2024-12-{next(counter)}')),
+        'POST /api/print/grocy[duplicate]': lambda: print_label('/api/print/grocy', grocy_label),
+        'POST /api/print/batch[10 labels]': lambda: print_label('/api/print/batch', json_body=
+                                                              {'defaults': {'font_family': font_family, 'font_size': 40},
+                                                               'labels': [{'text': f'Label {i}'} for i in range(5)] +
+                                                                         [{'printGrocy': True, 'grocycode': f'grcy:p:{i}', 'product': f'Produkt {i}'} for i in range(1, 6)]}),
+    }
+    for copies in (1, 10):
+        benchmarks[f'POST /api/print/text[copies={copies}]'] = lambda copies=copies: print_label('/api/print/text', dict(text_label, numCopies=copies))
+    return benchmarks
+
+def serve(app, threads):
+    """ runs the app on the threaded server (as LabelDesigner does) at a free local port; returns the port """
+    from wsgiref.simple_server import WSGIRequestHandler, make_server
+    from server_helpers import ThreadPoolWSGIServer
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args): pass
+
+    server_class = type('ThreadPoolWSGIServer', (ThreadPoolWSGIServer,), {'threads': threads})
+    server = make_server('127.0.0.1', 0, app, server_class, QuietHandler)
+    threading.Thread(target=server.serve_forever, name=f'benchmark-server-{threads}', daemon=True).start()
+    return server.server_port
+
+def concurrent_posts(port, path, forms):
+    """ POSTs all forms at the same time, each from its own client thread, and waits for the responses """
+    def post(form):
+        with urlopen(Request(f'http://127.0.0.1:{port}{path}', data=urlencode(form).encode('utf-8')), timeout=60) as response:
+            return response.read()
+    with ThreadPoolExecutor(max_workers=len(forms)) as executor:
+        return list(executor.map(post, forms))
+
+def load_benchmarks(font, clients=16, grocy_delay=0.1):
+    """
+    concurrent previews against the threaded server: `clients` clients request
+    a preview at the same time, every 4th of them a grocy label whose product
+    lookup takes `grocy_delay` seconds; with one thread all wait for each other
+    """
+    import bottle
+    import LabelDesigner as designer
+
+    family, style, path = font
+    stub = designer.grocy
+    app = bottle.default_app()
+    font_family = f'{family} ({style})'
+    counter = iter(range(10**9))
+
+    def forms():
+        # new texts and due dates every time, so the preview cache doesn't answer
+        return [{'printGrocy': 'true', 'grocycode': f'grcy:p:{i}', 'print_alias': 'true', 'due_date': f'2024-12-{next(counter)}',
+                 'font_family': font_family, 'font_size': 40, 'label_size': '57x32'}
+                if i % 4 == 3 else
+                {'text': f'Ofengemüse {next(counter)}', 'font_family': font_family, 'font_size': 40, 'label_size': '57x32'}
+                for i in range(clients)]
+
+    def run(port):
+        designer.product_lookup.invalidate()
+        stub.delay = grocy_delay
+        try:
+            concurrent_posts(port, '/api/preview/text', forms())
+        finally:
+            stub.delay = 0
+
+    benchmarks = {}
+    for threads in (1, 8):
+        port = serve(app, threads)
+        benchmarks[f'{clients} concurrent previews[threads={threads}]'] = lambda port=port: run(port)
+    return benchmarks
+
+# ---------------------------------------------------------------- runner
+
+def percentile(sorted_values, p):
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def measure(func, repeat, warmup):
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'runs':     repeat,
+            'mean_ms':  statistics.fmean(timings),
+            'p50_ms':   percentile(timings, 50),
+            'p90_ms':   percentile(timings, 90),
+            'p99_ms':   percentile(timings, 99),
+            'max_ms':   timings[-1],
+            'peak_kib': peak / 1024}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50, help='timed runs per benchmark (default 50)')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed runs before timing (default 3)')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run (--json) to compare the p50 latencies with')
+    parser.add_argument('--threshold', type=float, default=1.5, help='p50 ratio above which --compare reports a regression (default 1.5)')
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import LabelDesigner
+    font = find_font(LabelDesigner.CONFIG)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        benchmarks = {}
+        benchmarks.update(rendering_benchmarks(font[2]))
+        benchmarks.update(text_layout_benchmarks(font[2]))
+        benchmarks.update(font_benchmarks(output_dir))
+        benchmarks.update(labelprint_benchmarks(output_dir))
+        benchmarks.update(endpoint_benchmarks(font))
+        benchmarks.update(load_benchmarks(font))
+
+        print(f'Python {sys.version.split()[0]}, font {font[0]} ({font[1]}), {args.repeat} runs each\n')
+        print(f"{'benchmark':<44} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'peak mem':>10}")
+        results = {}
+        for name, func in benchmarks.items():
+            if args.filter not in name: continue
+            result = results[name] = measure(func, args.repeat, args.warmup)
+            print(f"{name:<44} {result['mean_ms']:>6.2f}ms {result['p50_ms']:>6.2f}ms {result['p90_ms']:>6.2f}ms "
+                  f"{result['p99_ms']:>6.2f}ms {result['max_ms']:>6.2f}ms {result['peak_kib']:>7.0f}KiB")
+
+    try:
+        import resource  # not available on Windows
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f'\nmax. resident set size: {max_rss / 1024:.0f} MiB')
+    except ImportError:
+        max_rss = None
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fh:
+            json.dump({'python': sys.version.split()[0], 'max_rss_kib': max_rss, 'results': results}, fh, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as fh:
+            baseline = json.load(fh)['results']
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline: continue
+            ratio = result['p50_ms'] / max(baseline[name]['p50_ms'], 1e-6)
+            if ratio > args.threshold:
+                regressions.append(f'{name}: p50 {baseline[name]["p50_ms"]:.2f}ms -> {result["p50_ms"]:.2f}ms ({ratio:.2f}x)')
+        if regressions:
+            print('\nRegressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+        print(f'\nNo p50 regressions above {args.threshold:.2f}x against {args.compare}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import threading, time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with an optional time-to-live.
+
+    Holds at most `maxsize` entries (and, if `max_bytes` is set, values of at
+    most `max_bytes` total size, measured with `sizeof`, len() by default);
+    the least recently used one is evicted first. Entries older than `ttl` seconds are treated as missing.
+    Hit, miss and eviction counters are kept for monitoring.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, max_bytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored_at = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _size(self, value):
+        return self.sizeof(value) if self.max_bytes is not None else 0
+
+    def _remove(self, key):
+        value, _ = self._data.pop(key)
+        self.bytes -= self._size(value)
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.monotonic())
+            self.bytes += self._size(value)
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes and len(self._data) > 1):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def get_or_create(self, key, factory):
+        """ Return the cached value for `key` or create, store and return it by calling `factory()` """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """ Drop a single entry or, without `key`, the whole cache """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+                self.bytes = 0
+            elif key in self._data:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {'size':      len(self._data),
+                    'maxsize':   self.maxsize,
+                    'ttl':       self.ttl,
+                    'bytes':     self.bytes,
+                    'hits':      self.hits,
+                    'misses':    self.misses,
+                    'evictions': self.evictions}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
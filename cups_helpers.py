@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import logging, queue, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+def cups_errors(retryable=False):
+    """
+    The exceptions of a failed CUPS request, with `retryable` only those of a
+    broken connection. pycups is imported here on first use, not on import.
+    """
+    import cups
+    return (RuntimeError, cups.HTTPError) if retryable else (RuntimeError, cups.IPPError, cups.HTTPError)
+
+class ConnectionPool:
+    """
+    Thread-safe pool of CUPS connections shared by all print paths.
+
+    Connections are created lazily (at most `size` of them) and handed out
+    exclusively, as a pycups connection must not be used by two threads at
+    once. A connection that was idle for more than `max_idle` seconds is
+    checked before it is handed out, and connections that raised an error
+    are dropped, so the next user gets a fresh one. Connections are created
+    by `connection_factory` (default: cups.Connection).
+    """
+
+    def __init__(self, connection_factory=None, size=4, max_idle=30, timeout=30):
+        self.connection_factory = connection_factory
+        self.size = size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.created = 0
+        self.discarded = 0
+
+    def _healthy(self, cups_connection):
+        try:
+            cups_connection.getDefault()
+            return True
+        except cups_errors() as e:
+            logger.info('Dropping stale CUPS connection: %s', e)
+            return False
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError('No CUPS connection available')
+        try:
+            while True:
+                try:
+                    cups_connection, released_at = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if time.monotonic() - released_at < self.max_idle or self._healthy(cups_connection):
+                    return cups_connection
+                self.discarded += 1
+            if self.connection_factory is None:
+                import cups
+                self.connection_factory = cups.Connection
+            cups_connection = self.connection_factory()
+            self.created += 1
+            return cups_connection
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, cups_connection, broken=False):
+        if broken:
+            self.discarded += 1
+        else:
+            self._idle.put((cups_connection, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """ Context manager handing out a connection; it's dropped if the block raised a CUPS error """
+        cups_connection = self.acquire()
+        try:
+            yield cups_connection
+        except cups_errors() + (JobNotCanceled,):
+            self.release(cups_connection, broken=True)
+            raise
+        except BaseException:
+            self.release(cups_connection)
+            raise
+        self.release(cups_connection)
+
+    def run(self, func, retries=1):
+        """
+        Call `func(cups_connection)` with a pooled connection. If the connection
+        turns out to be broken (HTTPError or RuntimeError from pycups), the
+        call is retried up to `retries` times with a new connection
+        (print_bytes() cancels its job first, see there).
+        """
+        while True:
+            try:
+                with self.connection() as cups_connection:
+                    return func(cups_connection)
+            except cups_errors(retryable=True) as e:
+                if retries <= 0: raise
+                retries -= 1
+                logger.info('Reconnecting to CUPS after error: %s', e)
+
+    def stats(self):
+        return {'size':      self.size,
+                'idle':      self._idle.qsize(),
+                'created':   self.created,
+                'discarded': self.discarded}
+
+class JobNotCanceled(Exception):
+    """
+    Submitting the document of a created CUPS job failed and the job
+    couldn't be canceled either; it may still print, so it's not retried.
+    """
+
+    def __init__(self, job_id, error):
+        super().__init__(f'CUPS job {job_id} failed and could not be canceled: {error}')
+        self.job_id = job_id
+
+def print_bytes(cups_connection, printer, data, title, options=None, document_format='application/pdf'):
+    """
+    Submit an in-memory document to CUPS without writing it to disk first.
+    Returns the CUPS job id.
+
+    If sending the document fails, the created job is canceled before the
+    error is raised, so a retry doesn't leave an orphaned job or print twice.
+    """
+    job_id = cups_connection.createJob(printer, title, options or {})
+    try:
+        cups_connection.startDocument(printer, job_id, title, document_format, 1)
+        try:
+            status = cups_connection.writeRequestData(data, len(data))
+            import cups
+            if status != cups.HTTP_CONTINUE:
+                raise cups.IPPError(status, 'Sending the document to CUPS failed')
+        finally:
+            cups_connection.finishDocument(printer)
+    except cups_errors() as e:
+        try:
+            cups_connection.cancelJob(job_id)
+        except cups_errors() as cancel_error:
+            logger.warning('Could not cancel CUPS job %s: %s', job_id, cancel_error)
+            raise JobNotCanceled(job_id, e) from e
+        logger.info('Canceled CUPS job %s after error: %s', job_id, e)
+        raise
+    return job_id
+
+JOB_STATES = {
+    3: 'pending',
+    4: 'held',
+    5: 'processing',
+    6: 'stopped',
+    7: 'canceled',
+    8: 'aborted',
+    9: 'completed',
+}
+FINAL_JOB_STATES = (7, 8, 9)
+
+class JobMonitor:
+    """
+    Tracks the state of submitted CUPS jobs in a background thread,
+    so the print endpoints can return right after submitting a job.
+
+    The job states are queried with connections from `pool`.
+    At most `max_jobs` jobs are remembered. The functions in `listeners`
+    are called with (a copy of) every job that reached its final state.
+    """
+
+    def __init__(self, pool, interval=2, max_jobs=200):
+        self.pool = pool
+        self.interval = interval
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.listeners = []
+
+    def add(self, job_id, job_name):
+        """ Start tracking the CUPS job `job_id` """
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {'id':        job_id,
+                                  'name':      job_name,
+                                  'state':     'pending',
+                                  'reasons':   [],
+                                  'submitted': now,
+                                  'updated':   now,
+                                  'finished':  False}
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        self._ensure_thread()
+        self._wakeup.set()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        """ Return a copy of the tracked job or None """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def _active_job_ids(self):
+        with self._lock:
+            return [job_id for job_id, job in self._jobs.items() if not job['finished']]
+
+    def _update(self, job_id, attributes):
+        state = attributes.get('job-state')
+        reasons = attributes.get('job-state-reasons', [])
+        if isinstance(reasons, str): reasons = [reasons]
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None: return
+            job['state'] = JOB_STATES.get(state, str(state))
+            job['reasons'] = list(reasons)
+            job['updated'] = time.time()
+            finished = state in FINAL_JOB_STATES and not job['finished']
+            job['finished'] = state in FINAL_JOB_STATES
+            job = dict(job)
+        if finished: self._notify(job)
+        if state in (7, 8):
+            logger.warning('Print Job ID: %s, ERROR Status %s', job_id, reasons)
+        else:
+            logger.info('Print Job ID: %s, Status: %s %s', job_id, JOB_STATES.get(state, state), reasons)
+
+    def _fail(self, job_id, error):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None: return
+            job['state'] = 'unknown'
+            job['error'] = str(error)
+            job['updated'] = time.time()
+            job['finished'] = True
+            job = dict(job)
+        self._notify(job)
+        logger.warning('Print Job: could not query job %s: %s', job_id, error)
+
+    def _notify(self, job):
+        for listener in self.listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                logger.warning('Print Job: listener failed for job %s: %s', job['id'], e)
+
+    def poll(self, cups_connection):
+        """ Query the state of all unfinished jobs once """
+        import cups
+        for job_id in self._active_job_ids():
+            try:
+                self._update(job_id, cups_connection.getJobAttributes(job_id))
+            except cups.IPPError as e:
+                self._fail(job_id, e)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self._active_job_ids(): continue
+            try:
+                self.pool.run(self.poll)
+            except Exception as e:
+                logger.warning('Print Job: could not query CUPS: %s', e)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is not None: return
+            self._thread = threading.Thread(target=self._run, name='cups-job-monitor', daemon=True)
+        self._thread.start()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Native raster output for the DYMO LabelWriter 450 series, see the
+"LabelWriter 450 Series Printers Technical Reference Manual".
+
+The label image is sent line by line as 1-bit raster data at the print
+head's resolution, so neither a PDF nor the CUPS filters are involved.
+"""
+
+import logging, socket
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+HEAD_DOTS = 672  # print head width of the LabelWriter 450 in dots
+DPI = 300
+
+ESC = b'\x1b'
+SYN = b'\x16'  # a line of raster data follows
+
+DENSITIES = {'light': b'c', 'medium': b'd', 'normal': b'e', 'dark': b'g'}
+
+# bit set (= dot printed) for everything darker than mid-gray
+DOT_TABLE = [255] * 128 + [0] * 128
+
+def raster_lines(label_image, rotate=False):
+    """ Return (bytes per line, list of raster lines) of a label image, cropped to the print head """
+    if label_image.mode != 'L':
+        label_image = label_image.convert('L')
+    if rotate:
+        from PIL import Image
+        label_image = label_image.transpose(Image.ROTATE_90)
+    if label_image.size[0] > HEAD_DOTS:
+        label_image = label_image.crop((0, 0, HEAD_DOTS, label_image.size[1]))
+    width, height = label_image.size
+    bytes_per_line = (width + 7) // 8
+    data = label_image.point(DOT_TABLE, '1').tobytes()
+    return bytes_per_line, [data[i:i + bytes_per_line] for i in range(0, height * bytes_per_line, bytes_per_line)]
+
+def labels_to_raster(labels, rotate=False, density='normal', dot_tab=0):
+    """
+    Return a LabelWriter print job (bytes) for a list of (label image, copies) tuples.
+    Every label is converted once; copies repeat its raster lines followed by a form feed.
+    `dot_tab` shifts the labels to the right by that many bytes (8 dots each).
+    """
+    job = bytearray(ESC + b'@')                                # reset
+    job += ESC + DENSITIES[density] + ESC + b'h'               # print density, 300x300 dpi text mode
+    job += ESC + b'B' + bytes([dot_tab])
+    for label_image, num_copies in labels:
+        bytes_per_line, lines = raster_lines(label_image, rotate)
+        page = bytearray(ESC + b'D' + bytes([bytes_per_line]))
+        page += ESC + b'L' + len(lines).to_bytes(2, 'big')     # label length in dot lines
+        for line in lines:
+            page += SYN + line
+        page += ESC + b'E'                                     # form feed to the next label
+        job += page * max(int(num_copies), 1)
+    return bytes(job)
+
+def label_to_raster(label_image, num_copies=1, rotate=False, density='normal', dot_tab=0):
+    return labels_to_raster([(label_image, num_copies)], rotate, density, dot_tab)
+
+def send_raw(target, data, timeout=30):
+    """
+    Send a raw print job to `target`, either a device or file
+    ('file:///dev/usb/lp0') or a network printer ('tcp://192.168.0.23:9100').
+    """
+    url = urlparse(target)
+    if url.scheme == 'file':
+        with open(url.path, 'wb') as fh:
+            fh.write(data)
+    elif url.scheme == 'tcp':
+        with socket.create_connection((url.hostname, url.port or 9100), timeout=timeout) as connection:
+            connection.sendall(data)
+    else:
+        raise ValueError(f'Unsupported raw printer target {target}, use file:// or tcp://')
+    logger.info('Sent %d bytes to %s', len(data), target)
@@ -1,9 +1,35 @@
 #!/usr/bin/env python
 
-import logging, subprocess
+import json, logging, os, struct, subprocess, sys, threading
+
+from cache_helpers import LRUCache
 
 logger = logging.getLogger(__name__)
 
+FONT_CACHE = LRUCache(maxsize=64)
+
+def get_font(path, size):
+    """
+    Return the parsed TrueType/OpenType font for (path, size).
+    Fonts are kept in a shared LRU cache so the font file is parsed only once.
+    """
+    def load():
+        from PIL import ImageFont
+        return ImageFont.truetype(path, size)
+    return FONT_CACHE.get_or_create((path, size), load)
+
+def preload_fonts(fonts, sizes):
+    """
+    Parse the given font paths at the given sizes ahead of time to warm the font cache.
+    Fonts that cannot be loaded are skipped.
+    """
+    for path in fonts:
+        for size in sizes:
+            try:
+                get_font(path, size)
+            except OSError as e:
+                logger.warning('Could not preload font %s: %s', path, e)
+
 def get_fonts(folder=None):
     """
     Scan a folder (or the system) for .ttf / .otf fonts and
@@ -40,3 +66,186 @@ def get_fonts(folder=None):
             fonts[families[i]][styles[i]] = path
             logger.debug("Added this font: " + str((families[i], styles[i], path)))
     return fonts
+
+# Folders scanned for fonts when no folders are configured (the usual font folders of the platform)
+if sys.platform == 'win32':
+    FONT_DIRS = [os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'),
+                 os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Microsoft', 'Windows', 'Fonts')]
+elif sys.platform == 'darwin':
+    FONT_DIRS = ['/Library/Fonts', '/System/Library/Fonts', '~/Library/Fonts']
+else:
+    FONT_DIRS = ['/usr/share/fonts', '/usr/local/share/fonts', '~/.fonts', '~/.local/share/fonts']
+FONT_EXTENSIONS = ('.ttf', '.otf')
+
+def read_name_table(path):
+    """
+    Return {name id: name} of the English entries of the 'name' table of a
+    TrueType/OpenType font (the first font of a collection); {} if the file
+    has no readable name table.
+    """
+    with open(path, 'rb') as fh:
+        try:
+            header = fh.read(12)
+            if header[:4] == b'ttcf':
+                fh.seek(struct.unpack('>I', fh.read(4))[0])
+                header = fh.read(12)
+            num_tables = struct.unpack('>H', header[4:6])[0]
+            for _ in range(num_tables):
+                tag, _, offset, length = struct.unpack('>4sIII', fh.read(16))
+                if tag == b'name': break
+            else:
+                return {}
+            fh.seek(offset)
+            table = fh.read(length)
+            count, string_offset = struct.unpack('>HH', table[2:6])
+            names, ranks = {}, {}
+            for i in range(count):
+                platform, encoding, language, name_id, size, start = struct.unpack('>6H', table[6 + i * 12:18 + i * 12])
+                # Windows en-US first, then any Windows/Unicode name, then Mac Roman English
+                if platform == 3:   rank = 0 if language == 0x409 else 1
+                elif platform == 0: rank = 1
+                elif platform == 1 and encoding == 0 and language == 0: rank = 2
+                else: continue
+                if rank >= ranks.get(name_id, 3): continue
+                raw = table[string_offset + start:string_offset + start + size]
+                names[name_id] = raw.decode('mac_roman' if platform == 1 else 'utf-16-be', errors='replace')
+                ranks[name_id] = rank
+            return names
+        except struct.error:
+            return {}
+
+def read_font_names(path):
+    """
+    Return the (family, style) names of a font file like fontconfig lists
+    them: the names Pillow reports, the legacy names (name IDs 1/2) and the
+    typographic names (IDs 16/17), e.g. "Roboto Condensed" / "Light" besides
+    "Roboto Condensed Light" / "Regular".
+    """
+    from PIL import ImageFont
+    family, style = ImageFont.truetype(path, 10).getname()
+    table = read_name_table(path)
+    names = [(family, style)]
+    for candidate in ((table.get(1, family), table.get(2, style)),
+                      (table.get(16, table.get(1, family)), table.get(17, table.get(2, style)))):
+        if candidate not in names:
+            names.append(candidate)
+    return names
+
+class FontIndex:
+    """
+    Persistent index of the .ttf / .otf fonts in a list of folders.
+
+    For every font file the index keeps path, its (family, style) names
+    (see read_font_names()), mtime and size, and for every folder its mtime,
+    font files and subfolders; it is stored as JSON at `path`.
+    A refresh only stats the folders: folders whose mtime didn't change are
+    not listed again, their files are taken from the index. In changed folders
+    only new or changed files are opened to read their names, removed files
+    are dropped. (A font file overwritten in place doesn't change the mtime
+    of its folder, it's read again once the folder changes.)
+    Folders later in the list take precedence for equal family and style.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path=None, folders=FONT_DIRS):
+        self.path = path
+        self.folders = [os.path.abspath(os.path.expanduser(folder)) for folder in folders if folder]
+        self.files = {}
+        self.dirs = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Loads the index file; a missing or unreadable index is treated as empty """
+        if not self.path:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as fh:
+                data = json.load(fh)
+        except (OSError, ValueError) as e:
+            logger.info('No usable font index at %s (%s), building it', self.path, e)
+            return
+        if data.get('version') == self.VERSION:
+            self.files = data.get('files', {})
+            self.dirs = data.get('dirs', {})
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as fh:
+                json.dump({'version': self.VERSION, 'files': self.files, 'dirs': self.dirs}, fh)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning('Could not save the font index to %s: %s', self.path, e)
+
+    def _refresh_folder(self, folder, files, dirs):
+        """
+        adds the font files below `folder` to `files` and the folders to `dirs`;
+        returns the number of (re)read font files
+        """
+        if folder in dirs:
+            return 0
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            return 0
+        known = self.dirs.get(folder)
+        if known is not None and known['mtime'] == mtime:
+            dirs[folder] = known
+            files.update((path, self.files[path]) for path in known['files'] if path in self.files)
+            return sum(self._refresh_folder(subfolder, files, dirs) for subfolder in known['subdirs'])
+
+        dirs[folder] = {'mtime': mtime, 'files': [], 'subdirs': []}
+        updated = 0
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return 0
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    dirs[folder]['subdirs'].append(entry.path)
+                    updated += self._refresh_folder(entry.path, files, dirs)
+                elif entry.name.lower().endswith(FONT_EXTENSIONS):
+                    stat = entry.stat()
+                    font = self.files.get(entry.path)
+                    if font is None or font['mtime'] != stat.st_mtime or font['size'] != stat.st_size:
+                        try:
+                            names = read_font_names(entry.path)
+                        except OSError as e:
+                            # remembered as unreadable until the file changes
+                            logger.debug('Skipping font %s: %s', entry.path, e)
+                            names = []
+                        font = {'names': names, 'mtime': stat.st_mtime, 'size': stat.st_size}
+                        updated += 1
+                    dirs[folder]['files'].append(entry.path)
+                    files[entry.path] = font
+            except OSError:
+                continue
+        return updated
+
+    def refresh(self):
+        """
+        Brings the index up to date with the folders and saves it if anything changed.
+        Returns the number of (re)read and removed font files.
+        """
+        with self._lock:
+            files, dirs = {}, {}
+            updated = sum(self._refresh_folder(folder, files, dirs) for folder in self.folders)
+            removed = len(set(self.files) - set(files))
+            changed = updated or removed or dirs != self.dirs
+            self.files, self.dirs = files, dirs
+        if changed:
+            self.save()
+        return updated, removed
+
+    def fonts(self):
+        """ Returns a dictionary of the structure family -> style -> file path """
+        fonts = {}
+        with self._lock:
+            for path, entry in self.files.items():
+                for family, style in entry['names']:
+                    fonts.setdefault(family, {})[style] = path
+        return fonts
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+import logging, re, threading, time, unicodedata
+from bisect import bisect_left
+
+from cache_helpers import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class ProductCatalog:
+    """
+    In-process cache of the Grocy product catalog (id, name, barcodes, userfields).
+
+    Readers always get the cached list immediately. Once the catalog is older
+    than `ttl` seconds (or after invalidate() was called) it is reloaded in a
+    background thread, so a request never has to wait for Grocy.
+    """
+
+    def __init__(self, grocy, ttl=300):
+        self.grocy = grocy
+        self.ttl = ttl
+        self._by_id = {}
+        self._products = []
+        self._loaded_at = None
+        self._db_changed = None
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.listeners = []
+
+    def fetch(self):
+        """
+        Download all products and their barcodes from Grocy (blocking)
+        and return a dictionary of the structure  product id -> product
+        """
+        from pygrocy.data_models.generic import EntityType  # pygrocy is slow to import
+
+        products = {}
+        for raw in self.grocy.get_generic_objects_for_type(EntityType.PRODUCTS):
+            product_id = int(raw['id'])
+            products[product_id] = {
+                'id':         product_id,
+                'name':       raw['name'],
+                'barcodes':   [],
+                'userfields': raw.get('userfields') or {},
+            }
+        for raw in self.grocy.get_generic_objects_for_type(EntityType.PRODUCT_BARCODES):
+            product = products.get(int(raw['product_id']))
+            if product is not None:
+                product['barcodes'].append(raw['barcode'])
+        return products
+
+    def refresh(self, force=False):
+        """
+        Reload the catalog from Grocy. Unless `force` is set, the download is
+        skipped if Grocy reports that its database didn't change since the last load.
+        Returns True if the catalog was reloaded.
+        """
+        try:
+            db_changed = self.grocy.get_last_db_changed()
+        except Exception as e:
+            logger.debug('Could not query the Grocy db-changed-time: %s', e)
+            db_changed = None
+
+        if not force and db_changed is not None and db_changed == self._db_changed:
+            with self._lock:
+                self._loaded_at = time.monotonic()
+            return False
+
+        products = self.fetch()
+        with self._lock:
+            self._by_id = products
+            self._products = sorted(products.values(), key=lambda p: p['name'].lower())
+            self._loaded_at = time.monotonic()
+            self._db_changed = db_changed
+            self.loaded = True
+        logger.info('Loaded %d products from Grocy', len(products))
+        for listener in self.listeners:
+            listener(self)
+        return True
+
+    def refresh_async(self, force=False):
+        """ Reload the catalog in a background thread (at most one at a time) """
+        with self._lock:
+            if self._refreshing: return
+            self._refreshing = True
+
+        def worker():
+            try:
+                self.refresh(force)
+            except Exception as e:
+                logger.warning('Refreshing the Grocy product catalog failed: %s', e)
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=worker, name='grocy-catalog-refresh', daemon=True).start()
+
+    def invalidate(self):
+        """ Mark the catalog as outdated and reload it in the background """
+        with self._lock:
+            self._loaded_at = None
+            self._db_changed = None
+        self.refresh_async(force=True)
+
+    def is_stale(self):
+        loaded_at = self._loaded_at
+        return loaded_at is None or time.monotonic() - loaded_at > self.ttl
+
+    def products(self):
+        """ Return the cached products sorted by name, triggering a background refresh if stale """
+        if self.is_stale(): self.refresh_async()
+        return self._products
+
+    def get(self, product_id):
+        """ Return the cached product with the given id or None """
+        if self.is_stale(): self.refresh_async()
+        return self._by_id.get(int(product_id))
+
+    def by_id(self):
+        """ Return the cached products as dictionary  product id -> product """
+        return self._by_id
+
+    def start(self, interval=None):
+        """ Load the catalog and keep it fresh with a periodic background refresh """
+        if self._thread is not None: return
+        interval = interval or self.ttl
+
+        def loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.warning('Refreshing the Grocy product catalog failed: %s', e)
+                if self._stop_event.wait(interval): break
+
+        self._thread = threading.Thread(target=loop, name='grocy-catalog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+class ProductLookup:
+    """
+    Memoizes the Grocy lookups needed to print a label:
+    barcode / grocycode -> product and product id -> userfields.
+
+    Both are LRU caches with a TTL, so renamed products and changed
+    userfields show up again after at most `ttl` seconds.
+    """
+
+    def __init__(self, grocy, maxsize=512, ttl=600):
+        self.grocy = grocy
+        self.maxsize = maxsize
+        self.products = LRUCache(maxsize, ttl)
+        self.userfields = LRUCache(maxsize, ttl)
+
+    def product_by_barcode(self, barcode):
+        """
+        Return the product for a barcode or grocycode as dict with 'id' and 'name'
+        (or None); unknown barcodes are cached as None, so they are asked only once
+        """
+        missing = object()
+        product = self.products.get(barcode, missing)
+        if product is missing:
+            from pygrocy.errors import GrocyError  # pygrocy is loaded with the Grocy client
+            try:
+                raw = self.grocy.product_by_barcode(barcode)
+            except GrocyError as e:
+                # Grocy answers 400 for unknown barcodes, server errors are not cached
+                if not e.is_client_error: raise
+                raw = None
+            product = {'id': raw.id, 'name': raw.name} if raw is not None else None
+            self.products.put(barcode, product)
+        return product
+
+    def get_userfields(self, product_id):
+        """ Return the userfields of a product as dictionary """
+        userfields = self.userfields.get(product_id)
+        if userfields is None:
+            userfields = self.grocy.get_userfields("products", product_id) or {}
+            self.userfields.put(product_id, userfields)
+        return userfields
+
+    def prewarm(self, catalog):
+        """
+        Fill both caches from a loaded ProductCatalog; caches too small for
+        the catalog grow to fit it, so the prewarm doesn't evict itself
+        """
+        by_id = catalog.by_id()
+        self.products.maxsize = max(self.maxsize, sum(1 + len(product['barcodes']) for product in by_id.values()))
+        self.userfields.maxsize = max(self.maxsize, len(by_id))
+        for product_id, product in by_id.items():
+            entry = {'id': product_id, 'name': product['name']}
+            self.products.put(f"grcy:p:{product_id}", entry)
+            for barcode in product['barcodes']:
+                self.products.put(barcode, entry)
+            self.userfields.put(product_id, product['userfields'])
+
+    def invalidate(self):
+        self.products.invalidate()
+        self.userfields.invalidate()
+
+    def stats(self):
+        return {'products':   self.products.stats(),
+                'userfields': self.userfields.stats()}
+
+WORD_PATTERN = re.compile(r'\w+')
+
+def normalize(text):
+    """ case folded text without accents, so 'Gemüse' is found as 'gemuse' """
+    text = unicodedata.normalize('NFKD', str(text).casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+def search_key(text):
+    """ normalized words of `text` separated by single spaces """
+    return ' '.join(WORD_PATTERN.findall(normalize(text)))
+
+def trigrams(text):
+    padded = f' {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class ProductSearchIndex:
+    """
+    Search index over the product catalog: name, alias userfield and barcodes.
+
+    Matches are ranked: exact matches, then names (or aliases, barcodes)
+    starting with the query, then products with words starting with every
+    word of the query, then products containing the query and last similar
+    products (at least `min_similarity` of the query's trigrams, not for
+    numbers). Within a rank products are sorted by similarity and name.
+    The index is rebuilt as a whole on every catalog refresh (see rebuild()).
+    """
+
+    def __init__(self, alias_userfield='kurzname', min_similarity=0.5):
+        self.alias_userfield = alias_userfield
+        self.min_similarity = min_similarity
+        self.loaded = False
+        self._index = ([], {}, {}, {}, [])
+
+    def rebuild(self, catalog):
+        """ Builds the index from the (loaded) ProductCatalog; used as catalog listener """
+        prefixes = []   # (normalized field or word, product id), sorted
+        grams = {}      # trigram -> product ids
+        fields = {}     # product id -> [normalized fields]
+        products = catalog.products()
+        for product in products:
+            alias = product['userfields'].get(self.alias_userfield)
+            texts = [search_key(text) for text in [product['name'], alias] + product['barcodes'] if text]
+            fields[product['id']] = texts
+            for text in texts:
+                prefixes.append((text, product['id']))
+                prefixes += [(word, product['id']) for word in text.split(' ') if word != text]
+                for gram in trigrams(text):
+                    grams.setdefault(gram, set()).add(product['id'])
+        prefixes.sort()
+        by_id = {product['id']: product for product in products}
+        self._index = (prefixes, grams, fields, by_id, products)
+        self.loaded = True
+        logger.info('Indexed %d products for the search', len(products))
+
+    def _prefixed(self, prefixes, query):
+        """ ids of the products with a field or word starting with `query` """
+        ids = set()
+        # walk the sorted list from the first candidate on (no slice, that would copy the rest of the list)
+        for i in range(bisect_left(prefixes, (query,)), len(prefixes)):
+            text, product_id = prefixes[i]
+            if not text.startswith(query): break
+            ids.add(product_id)
+        return ids
+
+    def search(self, query, offset=0, limit=20):
+        """
+        Returns (total number of matches, products [offset:offset + limit]) for the query,
+        every product as dict with id, name, alias and barcodes
+        """
+        if not self.loaded:
+            return 0, []
+        prefixes, grams, fields, by_id, products = self._index
+        query = search_key(query) if query else ''
+
+        if not query:
+            ids = [product['id'] for product in products]
+        else:
+            ranks = {}
+            def rank(product_ids, value, score=1.0):
+                for product_id in product_ids:
+                    if product_id not in ranks or ranks[product_id] > (value, -score):
+                        ranks[product_id] = (value, -score)
+
+            starting = self._prefixed(prefixes, query)
+            rank((product_id for product_id in starting if query in fields[product_id]), 0)
+            rank((product_id for product_id in starting
+                  if any(text.startswith(query) for text in fields[product_id])), 1)
+            words = query.split()
+            if len(words) > 1:
+                rank(set.intersection(*(self._prefixed(prefixes, word) for word in words)), 2)
+            else:
+                rank(starting, 2)
+
+            # barcodes share most of their trigrams, so numbers are only matched as prefix or substring
+            if len(query) >= 3:
+                fuzzy = not query.replace(' ', '').isdigit()
+                query_grams = trigrams(query)
+                counts = {}
+                for gram in query_grams:
+                    for product_id in grams.get(gram, ()):
+                        counts[product_id] = counts.get(product_id, 0) + 1
+                for product_id, count in counts.items():
+                    score = count / len(query_grams)
+                    if any(query in text for text in fields[product_id]):
+                        rank((product_id,), 3, score)
+                    elif fuzzy and score >= self.min_similarity:
+                        rank((product_id,), 4, score)
+
+            ids = sorted(ranks, key=lambda product_id: (ranks[product_id], fields[product_id][0]))
+
+        page = []
+        for product_id in ids[offset:offset + limit]:
+            product = by_id[product_id]
+            page.append({'id':       product_id,
+                         'name':     product['name'],
+                         'alias':    product['userfields'].get(self.alias_userfield),
+                         'barcodes': product['barcodes']})
+        return len(ids), page
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""
+Rendering of the label images. This module has no side effects on import,
+so the label rendering can also run in worker processes (see RenderPool).
+Like the other helpers it imports PIL on first use, so the server starts
+(and answers --help) without loading it.
+"""
+
+import logging, multiprocessing
+from io import BytesIO
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from font_helpers import get_font, preload_fonts
+from text_helpers import place_lines, draw_lines, text_fits, fit_font_size
+from pdf_helpers import image_to_pdf_bytes
+from metrics_helpers import span
+
+logger = logging.getLogger(__name__)
+
+# black for everything darker than mid-gray
+THRESHOLD_TABLE = [0] * 128 + [255] * 128
+
+def canvas_mode(kwargs):
+    """ labels for 1-bit output are drawn in grayscale and thresholded once at the end """
+    return 'RGB' if kwargs.get('mode', 'RGB') == 'RGB' else 'L'
+
+def finish_image(im, kwargs):
+    """ converts the drawn label to the requested output mode ('RGB', 'L' or '1') """
+    if kwargs.get('mode', 'RGB') == '1':
+        return im.point(THRESHOLD_TABLE, '1')
+    return im
+
+def scale_context(context, scale):
+    """
+    returns a copy of the label context for rendering at `scale` times the
+    print resolution (e.g. for previews at screen resolution)
+    """
+    if scale == 1:
+        return context
+    context = dict(context)
+    context['scale'] = scale
+    context['dpi'] = int(context['dpi']) * scale
+    context['font_size'] = max(round(context['font_size'] * scale), 1)
+    for key in ('margin_top', 'margin_bottom', 'margin_left', 'margin_right'):
+        context[key] = context[key] * scale
+    return context
+
+def text_offset(draw, text, font, kwargs):
+    """ returns the (horizontal, vertical) offset passed on to draw_multiline_text """
+    width, height = kwargs['width'], kwargs['height']
+    textsize = draw.multiline_textbbox(xy=(0,0),text=text, font=font)
+
+    vertical_offset  = (height - textsize[1])//2
+    vertical_offset += (kwargs['margin_top'] - kwargs['margin_bottom'])//2
+    horizontal_offset = max((width - textsize[2])//2, 0)
+    horizontal_offset = kwargs['margin_left'] - kwargs['margin_right']
+    return horizontal_offset, vertical_offset
+
+def fit_font(draw, img_size, text, offset_text, kwargs):
+    """
+    returns the largest font (up to the requested font_size) for which
+    the text fits on the label. Only the line layout is computed per
+    probed size, nothing is rendered.
+    """
+    def fits(size):
+        font = get_font(kwargs['font_path'], size)
+        return text_fits(img_size, text, font, kwargs, text_offset(draw, offset_text, font, kwargs))
+    font_size = fit_font_size(fits, kwargs['font_size'])
+    return get_font(kwargs['font_path'], font_size)
+
+def text_label_layout(text, kwargs):
+    """
+    lays out a text label without drawing it, shared by the raster and the vector output:
+    returns (label size in px, font, [(x, y, line), ...])
+    """
+    lines = []
+    for line in text.split('\n'):
+        if line == '': line = ' '
+        lines.append(line)
+    text = '\n'.join(lines)
+
+    width, height = kwargs['width'], kwargs['height']
+    scale = kwargs.get('scale', 1)
+    size = (round(width*10*scale), round(height*10*scale))
+    from PIL import Image, ImageDraw
+    draw = ImageDraw.Draw(Image.new('L', (1, 1)))  # only used for measuring
+
+    with span('font'):
+        if kwargs.get('auto_fit', False):
+            im_font = fit_font(draw, size, text, text, kwargs)
+        else:
+            im_font = get_font(kwargs['font_path'], kwargs['font_size'])
+
+    with span('text'):
+        offset = text_offset(draw, text, im_font, kwargs)
+        placed = place_lines(size, text, im_font, kwargs, offset)
+
+    return size, im_font, placed
+
+def create_label_im(text, **kwargs):
+    size, im_font, lines = text_label_layout(text, kwargs)
+    from PIL import Image
+    im = Image.new(canvas_mode(kwargs), size, 'white')
+    with span('text'):
+        draw_lines(im, lines, im_font, kwargs)
+    return finish_image(im, kwargs)
+
+def create_label_grocy(kwargs):
+    """
+    Erstellt ein Label mit Text und einem Code-128 Barcode nach dem Label-Template
+    (`template` im Kontext, sonst das Standard-Template der Labelgröße, siehe template_helpers).
+
+    :param kwargs: Label-Kontext mit product, due_date, grocycode, Labelgröße in mm und dpi
+    :return: PIL-Image des Labels
+    """
+    from template_helpers import compile_template
+    return compile_template(kwargs.get('template'), kwargs).render(kwargs)
+
+def image_to_png_bytes(im):
+    image_buffer = BytesIO()
+    im.save(image_buffer, format="PNG")
+    image_buffer.seek(0)
+    return image_buffer.read()
+
+def render_label_image(context):
+    """ renders the label image for a prepared label context, either a grocy or a text label """
+    context = scale_context(context, context.get('scale', 1))
+    if context['printGrocy']:
+        return create_label_grocy(dict(context))
+    return create_label_im(**context)
+
+def render_label_png(context):
+    """ renders the label and returns it as PNG (bytes) """
+    im = render_label_image(context)
+    with span('png'):
+        return image_to_png_bytes(im)
+
+def render_label_pdf(context, num_copies = 1):
+    """ renders the label and returns a PDF document (bytes) with `num_copies` pages """
+    im = render_label_image(context)
+    with span('pdf'):
+        return image_to_pdf_bytes(im, num_copies)
+
+def label_layout(context):
+    """
+    lays out the label for the vector output: returns a dict with the label size (px),
+    its resolution (dpi), the texts [(font, [(x, y, line), ...]), ...],
+    filled rectangles (e.g. barcode bars) [(x, y, width, height), ...] and fill color
+    """
+    kwargs = dict(context)
+    if context['printGrocy']:
+        from template_helpers import compile_template
+        return compile_template(kwargs.get('template'), kwargs).layout(kwargs)
+    size, font, lines = text_label_layout(kwargs['text'], kwargs)
+    return {'size': size, 'dpi': 254 * kwargs.get('scale', 1),  # text labels are laid out at 10 px/mm
+            'texts': [(font, lines)], 'rects': [], 'fill_color': kwargs.get('fill_color', 'black')}
+
+def render_label_vector_pdf(context, num_copies = 1):
+    """
+    renders the label as vector PDF (bytes) with `num_copies` pages: text with an
+    embedded font subset and the barcode as filled rectangles
+    """
+    from vector_pdf_helpers import layouts_to_vector_pdf
+    layout = label_layout(context)
+    try:
+        with span('pdf'):
+            return layouts_to_vector_pdf([(layout, num_copies)])
+    except ValueError as e:
+        logger.warning('Falling back to a raster PDF: %s', e)
+        return render_label_pdf(context, num_copies)
+
+def raster_context(context):
+    """ returns a copy of the label context rendering the label at the LabelWriter's resolution """
+    from dymo_helpers import DPI
+    # text labels are drawn at 10 px/mm (254 dpi), grocy labels at their dpi
+    base_dpi = int(context['dpi']) if context['printGrocy'] else 254
+    return dict(context, scale = context.get('scale', 1) * DPI / base_dpi)
+
+def render_label_raster(context, num_copies = 1, rotate = False, density = 'normal', dot_tab = 0):
+    """
+    renders the label at the LabelWriter's resolution and returns the raw
+    DYMO raster print job (bytes) with `num_copies` labels
+    """
+    from dymo_helpers import label_to_raster
+    im = render_label_image(raster_context(context))
+    with span('raster'):
+        return label_to_raster(im, num_copies, rotate, density, dot_tab)
+
+def warm_worker(font_paths, font_sizes):
+    """ initializer of the render worker processes: parses the default fonts ahead of time """
+    preload_fonts(font_paths, font_sizes)
+
+class RenderPool:
+    """
+    Dispatches label rendering to a pool of worker processes, so that
+    concurrent previews and batch prints use all CPU cores.
+
+    With `processes` set to 0 the rendering runs on the calling thread.
+    The workers are started with the 'spawn' method and preload the given
+    fonts; font and barcode caches then stay warm for the life of a worker.
+    """
+
+    def __init__(self, processes=0, font_paths=(), font_sizes=()):
+        self.processes = processes
+        self._executor = None
+        if processes > 0:
+            self._executor = ProcessPoolExecutor(max_workers=processes,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=warm_worker,
+                                                 initargs=(list(font_paths), list(font_sizes)))
+
+    def submit(self, func, *args):
+        """ schedules func(*args) and returns a Future """
+        if self._executor is not None:
+            return self._executor.submit(func, *args)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def run(self, func, *args):
+        """ runs func(*args) in the pool and waits for the result """
+        return self.submit(func, *args).result()
+
+    def warm(self):
+        """ starts the worker processes and waits until they have preloaded their fonts """
+        for future in [self.submit(int) for _ in range(self.processes)]:
+            future.result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
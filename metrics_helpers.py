@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+class Counter:
+    """ Monotonically increasing counter, one value per combination of label values """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """ yields (sample name, labels, value) """
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labels, key)), value
+
+class Histogram:
+    """ Histogram of observed values (e.g. latencies in seconds) with cumulative buckets """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le='+Inf' if bound == float('inf') else repr(bound)), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+class Registry:
+    """
+    Collection of metrics rendered in the Prometheus text format.
+    Collectors are functions called at every scrape; they return
+    (name, kind, help, [(labels, value), ...]) tuples for values that are
+    kept elsewhere (e.g. cache statistics).
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} {metric.kind}']
+            lines += [f'{name}{format_labels(labels)} {value}' for name, labels, value in metric.samples()]
+        for collector in self.collectors:
+            for name, kind, help, samples in collector():
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+                lines += [f'{name}{format_labels(labels)} {value}' for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# Timing spans: the stages of the request handled on the current thread
+# are summed up per stage name, see span() and collect_spans().
+_local = threading.local()
+
+def start_spans():
+    """ starts collecting the spans of the current thread (e.g. at the start of a request) """
+    _local.spans = {}
+    return _local.spans
+
+def finish_spans():
+    """ stops collecting and returns {stage: seconds} of the spans recorded since start_spans() """
+    spans = getattr(_local, 'spans', None) or {}
+    _local.spans = None
+    return spans
+
+def add_spans(spans):
+    """ adds spans measured elsewhere (e.g. in a render worker process) to the current collection """
+    current = getattr(_local, 'spans', None)
+    if current is None: return
+    for stage, seconds in spans.items():
+        current[stage] = current.get(stage, 0.0) + seconds
+
+@contextmanager
+def span(stage):
+    """ times the enclosed block as pipeline stage `stage` (no-op unless spans are collected) """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_spans({stage: time.perf_counter() - start})
+
+def collect_spans(func, *args):
+    """
+    Calls func(*args) and returns (result, {stage: seconds}) of the spans
+    recorded during the call. The spans are returned instead of recorded,
+    so this also works in a worker process of a RenderPool.
+    """
+    previous = getattr(_local, 'spans', None)
+    spans = start_spans()
+    try:
+        result = func(*args)
+    finally:
+        _local.spans = previous
+    return result, spans
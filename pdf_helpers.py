@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import zlib
+
+PDF_HEADER = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+
+COLOR_SPACES = {
+    '1':   (b'/DeviceGray', 1),
+    'L':   (b'/DeviceGray', 8),
+    'RGB': (b'/DeviceRGB',  8),
+}
+
+def image_to_pdf_bytes(label_image, num_copies=1, resolution=72.0):
+    """
+    Return a PDF document (as bytes) with `num_copies` pages showing the label.
+
+    The image is embedded only once as image XObject and every page refers
+    to it, so additional copies only add a few bytes to the document.
+    `resolution` is the image resolution in dpi used to compute the page size.
+    """
+    return images_to_pdf_bytes([(label_image, num_copies)], resolution)
+
+def images_to_pdf_bytes(labels, resolution=72.0):
+    """
+    Return a multi-page PDF document (as bytes) for a list of (label image, copies) tuples.
+    Every label image is embedded once, its copies are pages referring to it.
+    """
+    objects = [None, None]  # catalog and page tree are filled in by write_pdf()
+    pages = []
+    for label_image, num_copies in labels:
+        image, content, page_size = image_objects(label_image, resolution)
+        objects += [image, content]
+        pages += [image_page(page_size, len(objects) - 1, len(objects))] * max(int(num_copies), 1)
+
+    return write_pdf(objects, pages)
+
+def image_objects(label_image, resolution=72.0):
+    """
+    Return the image XObject and the content stream showing it on a page,
+    both as PDF objects (bytes), and the page size in pt.
+    """
+    if label_image.mode not in COLOR_SPACES:
+        label_image = label_image.convert('RGB')
+    color_space, bits = COLOR_SPACES[label_image.mode]
+    width, height = label_image.size
+    page_width, page_height = width * 72.0 / resolution, height * 72.0 / resolution
+
+    image_data = zlib.compress(label_image.tobytes(), 6)
+    content = b'q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q' % (page_width, page_height)
+    image = (b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s '
+             b'/BitsPerComponent %d /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream'
+             % (width, height, color_space, bits, len(image_data), image_data))
+    return image, b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content), (page_width, page_height)
+
+def image_page(page_size, image_ref, content_ref):
+    """ Return the page object showing an image (see image_objects()) """
+    return (b'<< /Type /Page /Parent 2 0 R /MediaBox [ 0 0 %.4f %.4f ] '
+            b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>'
+            % (page_size[0], page_size[1], image_ref, content_ref))
+
+def write_pdf(objects, pages):
+    """
+    Return a PDF document (as bytes) of the given objects followed by the page objects.
+    Objects 1 and 2 are reserved for the catalog and the page tree, object
+    n is objects[n - 1]; page objects refer to the page tree as 2 0 R.
+    """
+    objects = list(objects)
+    first_page = len(objects) + 1
+    objects += pages
+    page_refs = b' '.join(b'%d 0 R' % (first_page + i) for i in range(len(pages)))
+    objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    objects[1] = b'<< /Type /Pages /Kids [ %s ] /Count %d >>' % (page_refs, len(pages))
+
+    pdf = bytearray(PDF_HEADER)
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, obj)
+
+    pdf += xref_trailer(offsets, len(pdf))
+    return bytes(pdf)
+
+def xref_trailer(offsets, xref):
+    """ Return the cross-reference table and trailer for objects 1..n at `offsets`, the table at offset `xref` """
+    table = bytearray(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1))
+    for offset in offsets:
+        table += b'%010d 00000 n \n' % offset
+    table += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets) + 1, xref)
+    return bytes(table)
+
+class PDFStreamWriter:
+    """
+    Writes a PDF document object by object to a binary file, so a document
+    with many pages is never held in memory. As with write_pdf(), objects 1
+    and 2 are the catalog and the page tree; close() writes them last.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.offsets = {}
+        self.pages = []
+        self._position = 0
+        self._write(PDF_HEADER)
+
+    def _write(self, data):
+        self.fh.write(data)
+        self._position += len(data)
+
+    def _write_object(self, number, obj):
+        self.offsets[number] = self._position
+        self._write(b'%d 0 obj\n%s\nendobj\n' % (number, obj))
+
+    def add(self, obj):
+        """ writes an object and returns its number """
+        number = len(self.offsets) + 3
+        self._write_object(number, obj)
+        return number
+
+    def add_page(self, page):
+        """ writes a page object (with /Parent 2 0 R) and returns its number """
+        number = self.add(page)
+        self.pages.append(number)
+        return number
+
+    def close(self):
+        """ writes the catalog, the page tree and the cross-reference table; the file stays open """
+        page_refs = b' '.join(b'%d 0 R' % number for number in self.pages)
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        self._write_object(2, b'<< /Type /Pages /Kids [ %s ] /Count %d >>' % (page_refs, len(self.pages)))
+        self._write(xref_trailer([self.offsets[number] for number in sorted(self.offsets)], self._position))
+
+def stream_object(data, entries=b'', compress=True):
+    """ Return a (Flate compressed) stream object with the additional dictionary `entries` """
+    if compress:
+        data, entries = zlib.compress(data, 9), entries + b' /Filter /FlateDecode'
+    return b'<< /Length %d%s >>\nstream\n%s\nendstream' % (len(data), entries, data)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+import itertools, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from wsgiref.simple_server import WSGIServer
+
+from bottle import WSGIRefServer
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    wsgiref server handling every request on a worker thread of a
+    bounded thread pool instead of serially on the accepting thread.
+
+    At most `threads` + `queued_requests` accepted connections are handled
+    or waiting for a thread; beyond that the server stops accepting and
+    further connections wait in the listen backlog (`request_queue_size`).
+    """
+
+    threads = 8
+    queued_requests = 8
+    request_queue_size = 64
+
+    def server_activate(self):
+        super().server_activate()
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='http')
+        self._slots = threading.BoundedSemaphore(self.threads + self.queued_requests)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._process_request, request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+class ThreadedWSGIRefServer(WSGIRefServer):
+    """
+    Bottle server adapter for the threaded wsgiref server.
+    Takes the number of worker threads as `threads` option (default 8) and
+    the number of connections waiting for a thread as `queued_requests` (default 8).
+    """
+
+    def run(self, app):
+        options = {'threads':         self.options.pop('threads', ThreadPoolWSGIServer.threads),
+                   'queued_requests': self.options.pop('queued_requests', ThreadPoolWSGIServer.queued_requests)}
+        self.options['server_class'] = type('ThreadPoolWSGIServer', (ThreadPoolWSGIServer,), options)
+        super().run(app)
+
+def get_server(name):
+    """
+    Returns the bottle server to run: 'threaded' for the threaded wsgiref
+    server, otherwise the name of a bottle server adapter
+    (e.g. 'wsgiref' for the single-threaded server or 'waitress').
+    """
+    if name == 'threaded':
+        return ThreadedWSGIRefServer
+    return name
+
+class LatestRequestTracker:
+    """
+    Remembers the newest request sequence number per client, so work for
+    requests that were superseded by a newer one of the same client can be
+    skipped or cancelled. At most `max_clients` clients are remembered.
+    """
+
+    def __init__(self, max_clients=1024):
+        self.max_clients = max_clients
+        self._latest = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def start(self, client, seq):
+        """ Registers request `seq` of `client`; returns False if a newer request was already seen """
+        with self._lock:
+            if self._latest.get(client, -1) > seq:
+                return False
+            self._latest.pop(client, None)
+            self._latest[client] = seq
+            while len(self._latest) > self.max_clients:
+                oldest = next(iter(self._latest))
+                self._latest.pop(oldest)
+                self._futures.pop(oldest, None)
+            return True
+
+    def is_superseded(self, client, seq):
+        with self._lock:
+            return self._latest.get(client, -1) > seq
+
+    def track(self, client, seq, future):
+        """ Remembers the pending work of a request and cancels the work of older requests of that client """
+        with self._lock:
+            previous = self._futures.get(client)
+            if self._latest.get(client, -1) > seq:
+                future.cancel()
+                return
+            self._futures[client] = (seq, future)
+        if previous is not None and previous[0] < seq:
+            previous[1].cancel()
+
+    def done(self, client, seq):
+        with self._lock:
+            entry = self._futures.get(client)
+            if entry is not None and entry[0] == seq:
+                del self._futures[client]
+
+class QueueFull(Exception):
+    """ raised by PrintQueue.submit() if the queue doesn't accept more jobs """
+
+class PrintQueue:
+    """
+    Bounded queue running print jobs on `workers` threads.
+
+    submit() returns right away with the queue entry of the job (id 'q1',
+    'q2', ...), its state ('queued', 'printing', 'printed' or 'failed') can
+    be looked up with get(). At most `max_pending` jobs wait or run at the
+    same time; beyond that submit() raises QueueFull. Jobs submitted with the
+    same idempotency key within `window` seconds run only once, duplicates
+    get the entry of the first job. Failed jobs are forgotten right away, so
+    a retry prints again. At most `max_jobs` entries are remembered.
+    """
+
+    def __init__(self, workers=1, max_pending=16, window=60, max_jobs=200):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.window = window
+        self.max_jobs = max_jobs
+        self.pending = 0
+        self.submitted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self._ids = itertools.count(1)
+        self._jobs = OrderedDict()    # queue id -> entry, oldest first
+        self._futures = {}            # queue id -> future of the waiting or running jobs
+        self._recent = OrderedDict()  # key -> (queue id, submitted at), oldest first
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='print')
+        self._lock = threading.Lock()
+
+    def submit(self, key, name, func, *args):
+        """
+        Schedules func(*args) as job `name` unless a job with the same `key`
+        (None: no deduplication) was submitted within the window.
+        Returns (entry, duplicate); raises QueueFull if the queue is full.
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._recent:
+                oldest, (_, submitted) = next(iter(self._recent.items()))
+                if now - submitted <= self.window: break
+                del self._recent[oldest]
+            if key is not None and key in self._recent:
+                job = self._jobs.get(self._recent[key][0])
+                if job is not None:
+                    self.duplicates += 1
+                    return dict(job), True
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise QueueFull(f'{self.pending} print jobs are waiting already')
+            self.pending += 1
+            self.submitted += 1
+            queue_id, created = f'q{next(self._ids)}', time.time()
+            self._jobs[queue_id] = {'id':        queue_id,
+                                    'name':      name,
+                                    'state':     'queued',
+                                    'submitted': created,
+                                    'updated':   created,
+                                    'finished':  False}
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+            if key is not None:
+                self._recent[key] = (queue_id, now)
+            job = dict(self._jobs[queue_id])
+            self._futures[queue_id] = self._executor.submit(self._run, key, queue_id, func, *args)
+        return job, False
+
+    def _run(self, key, queue_id, func, *args):
+        self._update(queue_id, state='printing')
+        try:
+            result = func(*args)
+        except Exception as e:
+            with self._lock:
+                entry = self._recent.get(key)
+                if entry is not None and entry[0] == queue_id:
+                    del self._recent[key]
+            self._update(queue_id, state='failed', error=str(e), finished=True)
+            raise
+        else:
+            self._update(queue_id, state='printed', result=result, finished=True)
+            return result
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self._futures.pop(queue_id, None)
+
+    def _update(self, queue_id, **changes):
+        with self._lock:
+            job = self._jobs.get(queue_id)
+            if job is None: return
+            job.update(changes, updated=time.time())
+
+    def get(self, queue_id):
+        """ Return a copy of the queue entry or None """
+        with self._lock:
+            job = self._jobs.get(queue_id)
+            return dict(job) if job is not None else None
+
+    def jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def wait(self, queue_id, timeout=None):
+        """ Waits until the job has been printed or failed and returns its entry """
+        with self._lock:
+            future = self._futures.get(queue_id)
+        if future is not None:
+            futures_wait([future], timeout)
+        return self.get(queue_id)
+
+    def stats(self):
+        with self._lock:
+            return {'workers':     self.workers,
+                    'pending':     self.pending,
+                    'max_pending': self.max_pending,
+                    'submitted':   self.submitted,
+                    'duplicates':  self.duplicates,
+                    'rejected':    self.rejected}
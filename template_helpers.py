@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+Label templates: the declarative layout of a grocy label per label size.
+
+A template is a dict (e.g. from LABEL.TEMPLATES in config.json) like
+
+    {"fields": [
+        {"type": "text",    "value": "{product}\\n{due_date}", "box": [0, 0, 57, 17.6],
+         "distribute_vertically": true},
+        {"type": "barcode", "value": "{grocycode}", "box": [0, 17.27, 57, 16]},
+        {"type": "text",    "value": "Vorrat", "box": [40, 0, 17, 4], "font_size": 30, "align": "right"},
+        {"type": "rect",    "box": [0, 17, 57, 0.2]}
+    ]}
+
+with the boxes as [x, y, width, height] in mm from the top left corner of
+the label. Values refer to the label context ({product}, {due_date},
+{grocycode}, ...); fields without references are static. Text fields take
+`font_size`, `align`, `vertical_align` and `distribute_vertically`, the
+other text options come from the label context.
+
+A template is compiled once per label size, resolution and font into
+pixel geometry and a layer with the static fields already drawn, so a
+label only draws its variable fields on a copy of that layer.
+"""
+
+import json, logging, math
+from string import Formatter
+
+from PIL import Image, ImageDraw, ImageFont
+
+from cache_helpers import LRUCache
+from font_helpers import get_font
+from text_helpers import place_lines, draw_lines
+from label_helpers import canvas_mode, finish_image, text_offset, fit_font
+from metrics_helpers import span
+
+logger = logging.getLogger(__name__)
+
+# compiled templates keep a full resolution static layer, so the cache is bounded by their size as well
+TEMPLATE_CACHE = LRUCache(maxsize=64, max_bytes=16 * 1024 * 1024, sizeof=lambda template: template.nbytes)
+
+FIELD_TYPES = ('text', 'barcode', 'rect')
+TEXT_OPTIONS = ('font_size', 'align', 'vertical_align', 'distribute_vertically')
+
+# everything in the label context a compiled template depends on (besides the template)
+COMPILE_KEYS = ('width', 'height', 'dpi', 'scale', 'mode', 'font_path', 'font_size', 'align', 'vertical_align', 'distribute_vertically',
+                'margin_top', 'margin_bottom', 'margin_left', 'margin_right', 'auto_fit', 'fill_color', 'fast_barcode')
+
+def default_template(width, height):
+    """ the grocy label: product and due date in the upper half, the barcode in the lower half """
+    # auf 57x32 Labels sitzt der Barcode 15 px (bei 300 dpi) tiefer
+    barcode_y = height / 2 + (15 / 300 * 25.4 if (width, height) == (57, 32) else 0)
+    return {'fields': [
+        {'type': 'text',    'value': '{product}\n{due_date}', 'box': [0, 0, width, height * 0.55], 'distribute_vertically': True},
+        {'type': 'barcode', 'value': '{grocycode}',           'box': [0, barcode_y, width, height / 2]},
+    ]}
+
+def is_static(field):
+    return field['type'] == 'rect' or not any(name is not None for _, name, _, _ in Formatter().parse(field['value']))
+
+def field_value(field, context):
+    try:
+        return field['value'].format_map(context)
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"Invalid value {field['value']!r} in the label template: {e}")
+
+class CompiledTemplate:
+    """
+    A label template resolved for one label size, resolution and font:
+    the pixel boxes of all fields, the static layer with the static fields
+    drawn and their geometry for the vector output.
+    """
+
+    def __init__(self, template, kwargs):
+        self.dpi = kwargs['dpi']
+        self.width, self.height = kwargs['width'], kwargs['height']
+        self.size = (int(self.width / 25.4 * self.dpi), int(self.height / 25.4 * self.dpi))
+        self.fields = []        # variable fields: (field, pixel box)
+        self.static_texts = []  # (font, placed lines)
+        self.static_rects = []  # (x, y, width, height) of rectangles and barcode bars
+
+        fields = template.get('fields') if isinstance(template, dict) else None
+        if not fields:
+            raise ValueError('A label template needs a list of fields')
+
+        self.static_layer = Image.new(canvas_mode(kwargs), self.size, 'white')
+        draw = ImageDraw.Draw(self.static_layer)
+        for field in fields:
+            if field.get('type') not in FIELD_TYPES:
+                raise ValueError(f"Invalid field type {field.get('type')!r} in the label template, choose from {', '.join(FIELD_TYPES)}")
+            box = self.pixel_box(field['box'])
+            if not is_static(field):
+                self.fields.append((field, box))
+            elif field['type'] == 'rect':
+                self.static_rects.append(box)
+                draw.rectangle((box[0], box[1], box[0] + box[2] - 1, box[1] + box[3] - 1), fill=kwargs.get('fill_color', 'black'))
+            elif field['type'] == 'text':
+                font, lines = self.layout_text(field, box, field['value'], kwargs)
+                self.static_texts.append((font, lines))
+                draw_lines(self.static_layer, lines, font, kwargs)
+            else:
+                self.static_layer.paste(self.barcode_image(field['value'], box, kwargs), box[:2])
+                self.static_rects += self.barcode_bars(field['value'], box)
+        # memory of the static layer (Pillow keeps at least a byte per pixel and band)
+        self.nbytes = self.size[0] * self.size[1] * len(self.static_layer.getbands())
+
+    def pixel_box(self, box):
+        """
+        [x, y, width, height] in mm -> pixels of the label: the box starts at
+        the first whole pixel and covers only whole pixels
+        """
+        if not isinstance(box, (list, tuple)) or len(box) != 4:
+            raise ValueError(f'Invalid box {box!r} in the label template, expected [x, y, width, height] in mm')
+        scale_x, scale_y = self.size[0] / self.width, self.size[1] / self.height
+        return (math.ceil(box[0] * scale_x - 1e-6), math.ceil(box[1] * scale_y - 1e-6),
+                int(box[2] * scale_x + 1e-6), int(box[3] * scale_y + 1e-6))
+
+    def layout_text(self, field, box, text, kwargs):
+        """ returns (font, placed lines) of a text field, positioned on the label """
+        kwargs = dict(kwargs, topHalf=False, **{key: field[key] for key in TEXT_OPTIONS if key in field})
+        if 'font_size' in field:
+            kwargs['font_size'] = max(round(field['font_size'] * kwargs.get('scale', 1)), 1)
+        box_size = box[2:]
+        first_line = text.split('\n')[0]
+        draw = ImageDraw.Draw(Image.new('L', (1, 1)))  # nur zum Messen
+
+        with span('font'):
+            try:
+                if kwargs.get('auto_fit', False):
+                    font = fit_font(draw, box_size, text, first_line, kwargs)
+                else:
+                    font = get_font(kwargs['font_path'], kwargs['font_size'])
+            except IOError:
+                font = ImageFont.load_default()
+
+        with span('text'):
+            offset = text_offset(draw, first_line, font, kwargs)
+            lines = place_lines(box_size, text, font, kwargs, offset)
+        return font, [(box[0] + x, box[1] + y, line) for x, y, line in lines]
+
+    def barcode_image(self, data, box, kwargs):
+        from barcode_helpers import get_barcode_image
+        with span('barcode'):
+            return get_barcode_image(data, box[2:], self.dpi, fast = kwargs.get('fast_barcode', True))
+
+    def barcode_bars(self, data, box):
+        from barcode_helpers import code128_bars
+        with span('barcode'):
+            return [(box[0] + x, box[1], width, box[3]) for x, width in code128_bars(data, box[2])]
+
+    def render(self, kwargs):
+        """ draws the variable fields of the label context on a copy of the static layer """
+        label_image = self.static_layer.copy()
+        for field, box in self.fields:
+            value = field_value(field, kwargs)
+            if field['type'] == 'text':
+                font, lines = self.layout_text(field, box, value, kwargs)
+                with span('text'):
+                    draw_lines(label_image, lines, font, kwargs)
+            else:
+                label_image.paste(self.barcode_image(value, box, kwargs), box[:2])
+        return finish_image(label_image, kwargs)
+
+    def layout(self, kwargs):
+        """ returns the label layout for the vector output (see label_helpers.label_layout()) """
+        texts, rects = list(self.static_texts), list(self.static_rects)
+        for field, box in self.fields:
+            value = field_value(field, kwargs)
+            if field['type'] == 'text':
+                texts.append(self.layout_text(field, box, value, kwargs))
+            else:
+                rects += self.barcode_bars(value, box)
+        return {'size': self.size, 'dpi': self.dpi, 'texts': texts, 'rects': rects,
+                'fill_color': kwargs.get('fill_color', 'black')}
+
+def compile_template(template, kwargs):
+    """
+    Returns the CompiledTemplate of `template` (None: the default template of
+    the label size) for the label context; compiled templates are cached.
+    """
+    if template is None:
+        template = default_template(kwargs['width'], kwargs['height'])
+    key = json.dumps([template, {key: kwargs.get(key) for key in COMPILE_KEYS}], sort_keys=True, default=str)
+    return TEMPLATE_CACHE.get_or_create(key, lambda: CompiledTemplate(template, kwargs))
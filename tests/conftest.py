@@ -0,0 +1,29 @@
+import os, sys, types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import cups
+except ImportError:
+    # pycups needs the CUPS headers to build; the tests only need its exception types
+    cups = types.ModuleType('cups')
+    cups.IPPError = type('IPPError', (Exception,), {})
+    cups.HTTPError = type('HTTPError', (Exception,), {})
+    cups.HTTP_CONTINUE = 100
+    cups.Connection = object
+    sys.modules['cups'] = cups
+
+@pytest.fixture(scope='session')
+def font():
+    """ (family, style, path) of an installed font, the label tests are skipped without one """
+    from font_helpers import FONT_DIRS, FontIndex
+    fonts = FontIndex(None, FONT_DIRS)
+    fonts.refresh()
+    fonts = fonts.fonts()
+    if not fonts:
+        pytest.skip('no .ttf/.otf font installed')
+    family = sorted(fonts)[0]
+    style = sorted(fonts[family])[0]
+    return family, style, fonts[family][style]
@@ -0,0 +1,22 @@
+import logging
+
+from barcode_helpers import code128_pattern, render_code128
+
+def modules(image, module_px):
+    """ the module pattern read back from the first row of a rendered barcode """
+    row = [image.getpixel((x, 0)) for x in range(image.size[0])]
+    start = next(x for x, value in enumerate(row) if value < 128)
+    end = len(row) - next(x for x, value in enumerate(reversed(row)) if value < 128)
+    return ''.join('1' if row[x] < 128 else '0' for x in range(start, end, module_px))
+
+def test_every_module_gets_the_same_pixels():
+    pattern = code128_pattern('grcy:p:93')
+    image = render_code128('grcy:p:93', (len(pattern) * 3 + 2, 40))
+    assert modules(image, 3) == pattern.rstrip('0')
+
+def test_too_narrow_barcodes_fall_back_with_a_warning(caplog):
+    pattern = code128_pattern('grcy:p:93:x:123456')
+    with caplog.at_level(logging.WARNING):
+        image = render_code128('grcy:p:93:x:123456', (len(pattern) - 10, 40))
+    assert image.size == (len(pattern) - 10, 40)
+    assert 'may not be readable' in caplog.text
@@ -0,0 +1,157 @@
+import threading, time
+
+import cups
+import pytest
+
+from cups_helpers import ConnectionPool, JobNotCanceled, print_bytes
+
+class FakeConnection:
+    """ stands in for cups.Connection: records the calls and fails where told to """
+
+    def __init__(self, fail=None, healthy=True):
+        self.fail = dict(fail or {})  # method name -> exception raised on the next call
+        self.healthy = healthy
+        self.calls = []
+        self.jobs = {}
+        self.next_job_id = 1
+
+    def _call(self, name, *args):
+        self.calls.append(name)
+        if name in self.fail:
+            raise self.fail.pop(name)
+
+    def getDefault(self):
+        self._call('getDefault')
+        if not self.healthy:
+            raise cups.HTTPError(-1)
+        return 'DYMO'
+
+    def createJob(self, printer, title, options):
+        self._call('createJob')
+        job_id, self.next_job_id = self.next_job_id, self.next_job_id + 1
+        self.jobs[job_id] = 'created'
+        return job_id
+
+    def startDocument(self, printer, job_id, title, document_format, last):
+        self._call('startDocument')
+
+    def writeRequestData(self, data, length):
+        self._call('writeRequestData')
+        return cups.HTTP_CONTINUE
+
+    def finishDocument(self, printer):
+        self._call('finishDocument')
+        for job_id, state in self.jobs.items():
+            if state == 'created': self.jobs[job_id] = 'printing'
+
+    def cancelJob(self, job_id):
+        self._call('cancelJob')
+        self.jobs[job_id] = 'canceled'
+
+class FakeFactory:
+    """ creates FakeConnections, the n-th one with the n-th of `fails` """
+
+    def __init__(self, *fails):
+        self.fails = list(fails)
+        self.connections = []
+
+    def __call__(self):
+        connection = FakeConnection(self.fails.pop(0) if self.fails else None)
+        self.connections.append(connection)
+        return connection
+
+def test_connections_are_handed_out_exclusively():
+    factory = FakeFactory()
+    pool = ConnectionPool(factory, size=2, timeout=0.2)
+    first, second = pool.acquire(), pool.acquire()
+    assert first is not second
+    with pytest.raises(RuntimeError):
+        pool.acquire()  # both connections are in use
+    pool.release(first)
+    assert pool.acquire() is first
+    assert pool.created == 2
+
+def test_waiting_for_a_connection_in_use():
+    pool = ConnectionPool(FakeFactory(), size=1, timeout=5)
+    connection = pool.acquire()
+    threading.Timer(0.1, pool.release, args=(connection,)).start()
+    started = time.monotonic()
+    assert pool.acquire() is connection
+    assert time.monotonic() - started >= 0.05
+
+def test_idle_connections_are_checked_before_reuse():
+    factory = FakeFactory()
+    pool = ConnectionPool(factory, size=1, max_idle=0)
+    connection = pool.acquire()
+    pool.release(connection)
+    assert pool.acquire() is connection
+    assert connection.calls == ['getDefault']
+
+    connection.healthy = False
+    pool.release(connection)
+    replacement = pool.acquire()
+    assert replacement is not connection
+    assert pool.discarded == 1 and pool.created == 2
+
+def test_recently_used_connections_are_not_checked():
+    pool = ConnectionPool(FakeFactory(), size=1, max_idle=30)
+    connection = pool.acquire()
+    pool.release(connection)
+    assert pool.acquire() is connection
+    assert connection.calls == []
+
+@pytest.mark.parametrize('error', [cups.IPPError(0, 'failed'), cups.HTTPError(-1), RuntimeError('closed')])
+def test_connections_are_discarded_after_cups_errors(error):
+    factory = FakeFactory()
+    pool = ConnectionPool(factory, size=1)
+    with pytest.raises(type(error)):
+        with pool.connection():
+            raise error
+    assert pool.discarded == 1
+    assert pool.stats()['idle'] == 0
+    with pool.connection() as connection:
+        assert connection is factory.connections[1]
+
+def test_connections_are_kept_after_other_errors():
+    pool = ConnectionPool(FakeFactory(), size=1)
+    with pytest.raises(KeyError):
+        with pool.connection():
+            raise KeyError('not a CUPS error')
+    assert pool.discarded == 0
+    assert pool.stats()['idle'] == 1
+
+def test_run_retries_with_a_new_connection():
+    factory = FakeFactory({'createJob': cups.HTTPError(-1)})
+    pool = ConnectionPool(factory, size=1)
+    assert pool.run(lambda connection: print_bytes(connection, 'DYMO', b'%PDF', 'label')) == 1
+    assert len(factory.connections) == 2 and pool.discarded == 1
+
+def test_run_gives_up_after_the_retries():
+    factory = FakeFactory({'createJob': cups.HTTPError(-1)}, {'createJob': cups.HTTPError(-1)})
+    pool = ConnectionPool(factory, size=1)
+    with pytest.raises(cups.HTTPError):
+        pool.run(lambda connection: print_bytes(connection, 'DYMO', b'%PDF', 'label'), retries=1)
+    assert pool.discarded == 2
+
+def test_run_does_not_retry_ipp_errors():
+    factory = FakeFactory({'createJob': cups.IPPError(1281, 'printer not found')})
+    pool = ConnectionPool(factory, size=1)
+    with pytest.raises(cups.IPPError):
+        pool.run(lambda connection: print_bytes(connection, 'DYMO', b'%PDF', 'label'))
+    assert len(factory.connections) == 1
+
+def test_a_failed_job_is_canceled_before_the_retry():
+    factory = FakeFactory({'writeRequestData': cups.HTTPError(-1)})
+    pool = ConnectionPool(factory, size=1)
+    job_id = pool.run(lambda connection: print_bytes(connection, 'DYMO', b'%PDF', 'label'))
+    first, second = factory.connections
+    assert first.jobs == {1: 'canceled'}
+    assert second.jobs == {job_id: 'printing'}
+
+def test_a_job_that_cannot_be_canceled_is_not_retried():
+    factory = FakeFactory({'writeRequestData': cups.HTTPError(-1), 'cancelJob': cups.HTTPError(-1)})
+    pool = ConnectionPool(factory, size=1)
+    with pytest.raises(JobNotCanceled) as error:
+        pool.run(lambda connection: print_bytes(connection, 'DYMO', b'%PDF', 'label'))
+    assert error.value.job_id == 1
+    assert len(factory.connections) == 1 and pool.discarded == 1
@@ -0,0 +1,44 @@
+import os, shutil, sys
+
+import font_helpers
+from font_helpers import FontIndex
+
+def font_folder(tmp_path, font):
+    folder = tmp_path / 'fonts'
+    (folder / 'sub').mkdir(parents=True)
+    shutil.copy(font[2], folder / 'sub' / 'a.ttf')
+    return folder
+
+def test_unchanged_folders_are_not_listed(tmp_path, font, monkeypatch):
+    folder = font_folder(tmp_path, font)
+    index_path = str(tmp_path / 'index.json')
+    assert FontIndex(index_path, [str(folder)]).refresh() == (1, 0)
+
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: listed.append(path) or scandir(path))
+    index = FontIndex(index_path, [str(folder)])
+    index.load()
+    assert index.refresh() == (0, 0)
+    assert listed == []
+    assert index.fonts() == {font[0]: {font[1]: str(folder / 'sub' / 'a.ttf')}}
+
+def test_changed_folders_are_listed_again(tmp_path, font):
+    folder = font_folder(tmp_path, font)
+    index_path = str(tmp_path / 'index.json')
+    FontIndex(index_path, [str(folder)]).refresh()
+
+    shutil.copy(font[2], folder / 'sub' / 'b.ttf')
+    os.utime(folder / 'sub', (0, 1))  # the folder's mtime may not tick within the test
+    index = FontIndex(index_path, [str(folder)])
+    index.load()
+    assert index.refresh() == (1, 0)
+
+    (folder / 'sub' / 'a.ttf').unlink()
+    os.utime(folder / 'sub', (0, 2))
+    assert index.refresh() == (0, 1)
+    assert index.fonts() == {font[0]: {font[1]: str(folder / 'sub' / 'b.ttf')}}
+
+def test_font_dirs_of_the_platform():
+    windows = os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts')
+    assert (windows in font_helpers.FONT_DIRS) == (sys.platform == 'win32')
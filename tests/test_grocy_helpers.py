@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import pytest
+from pygrocy.errors import GrocyError
+
+from grocy_helpers import ProductCatalog, ProductLookup, ProductSearchIndex
+
+class FakeGrocy:
+    """
+    stands in for pygrocy.Grocy with the products {id: name}, their
+    userfields {id: {...}} and barcodes [(product id, barcode), ...];
+    like Grocy it answers unknown barcodes with HTTP 400
+    """
+
+    def __init__(self, products, status_code=400, userfields=None, barcodes=()):
+        self.products = products
+        self.status_code = status_code
+        self.userfields = dict(userfields or {})
+        self.barcodes = list(barcodes)
+        self.db_changed = 1
+        self.lookups = []
+
+    def product_by_barcode(self, barcode):
+        self.lookups.append(barcode)
+        product_id = int(barcode.rpartition(':')[2])
+        if product_id not in self.products:
+            raise GrocyError(SimpleNamespace(status_code=self.status_code, text=''))
+        return SimpleNamespace(id=product_id, name=self.products[product_id])
+
+    def get_userfields(self, entity, object_id):
+        return self.userfields.get(object_id, {})
+
+    def get_last_db_changed(self):
+        return self.db_changed
+
+    def get_generic_objects_for_type(self, entity_type):
+        if 'barcode' in str(entity_type).lower():
+            return [{'product_id': product_id, 'barcode': barcode} for product_id, barcode in self.barcodes]
+        return [{'id': product_id, 'name': name, 'userfields': self.get_userfields('products', product_id)}
+                for product_id, name in self.products.items()]
+
+def test_lookup_caches_products():
+    grocy = FakeGrocy({93: 'Ofengemüse'})
+    lookup = ProductLookup(grocy)
+    assert lookup.product_by_barcode('grcy:p:93') == {'id': 93, 'name': 'Ofengemüse'}
+    assert lookup.product_by_barcode('grcy:p:93') == {'id': 93, 'name': 'Ofengemüse'}
+    assert grocy.lookups == ['grcy:p:93']
+
+def test_unknown_barcodes_are_none_and_cached():
+    grocy = FakeGrocy({93: 'Ofengemüse'})
+    lookup = ProductLookup(grocy)
+    assert lookup.product_by_barcode('grcy:p:4711') is None
+    assert lookup.product_by_barcode('grcy:p:4711') is None
+    assert grocy.lookups == ['grcy:p:4711']
+
+def test_server_errors_are_raised_and_not_cached():
+    grocy = FakeGrocy({}, status_code=500)
+    lookup = ProductLookup(grocy)
+    for _ in range(2):
+        with pytest.raises(GrocyError):
+            lookup.product_by_barcode('grcy:p:93')
+    assert len(grocy.lookups) == 2
+
+def search_index(grocy):
+    catalog = ProductCatalog(grocy)
+    index = ProductSearchIndex(alias_userfield='kurzname')
+    catalog.listeners.append(index.rebuild)
+    catalog.refresh()
+    return catalog, index
+
+def names(index, query, **kwargs):
+    return [product['name'] for product in index.search(query, **kwargs)[1]]
+
+def test_search_ranking():
+    grocy = FakeGrocy({1: 'Hafermilch', 2: 'Milchreis', 3: 'Milck', 4: 'Bio Milch', 5: 'Milch', 6: 'Käse'})
+    _, index = search_index(grocy)
+    # exact, starting with the query, a word starting with it, containing it, similar
+    assert names(index, 'milch') == ['Milch', 'Milchreis', 'Bio Milch', 'Hafermilch', 'Milck']
+    assert names(index, 'MILCH') == names(index, 'milch')
+    assert names(index, 'bio mil') == ['Bio Milch']
+    assert names(index, 'tofu') == []
+
+def test_search_alias_barcodes_and_accents():
+    grocy = FakeGrocy({1: 'Ofengemüse', 2: 'Orangensaft'}, userfields={2: {'kurzname': 'OSaft'}},
+                      barcodes=[(1, '4006381333931'), (2, '4311501044486')])
+    _, index = search_index(grocy)
+    assert names(index, 'ofengemuse') == ['Ofengemüse']
+    assert names(index, 'osaft') == ['Orangensaft']
+    assert names(index, '4006') == ['Ofengemüse']
+    # barcodes share most of their trigrams, other numbers don't match them as similar
+    assert names(index, '4006381333000') == []
+    total, page = index.search('orangen')
+    assert total == 1 and page[0] == {'id': 2, 'name': 'Orangensaft', 'alias': 'OSaft', 'barcodes': ['4311501044486']}
+
+def test_search_pages():
+    grocy = FakeGrocy({i: f'Produkt {i:02d}' for i in range(1, 31)})
+    _, index = search_index(grocy)
+    total, page = index.search('produkt', offset=20, limit=20)
+    assert total == 30 and [product['id'] for product in page] == list(range(21, 31))
+    assert index.search('', limit=5)[0] == 30
+
+def test_search_index_follows_the_catalog():
+    grocy = FakeGrocy({1: 'Milch'})
+    catalog, index = search_index(grocy)
+    assert names(index, 'reis') == []
+    grocy.products[2] = 'Reis'
+    assert not catalog.refresh()  # Grocy reports no change, so the catalog isn't loaded again
+    assert names(index, 'reis') == []
+    grocy.db_changed += 1
+    assert catalog.refresh()
+    assert names(index, 'reis') == ['Reis']
@@ -0,0 +1,123 @@
+import io, json, os
+from types import SimpleNamespace
+from urllib.parse import urlencode
+
+import pytest
+
+from grocy_helpers import ProductLookup
+from server_helpers import PrintQueue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class FakeGrocyProduct:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+class FakeGrocy:
+    """ stands in for pygrocy.Grocy with the products {id: name} """
+
+    def __init__(self, products):
+        self.products = products
+        self.lookups = []
+
+    def product_by_barcode(self, barcode):
+        self.lookups.append(barcode)
+        product_id = int(barcode.rpartition(':')[2])
+        return FakeGrocyProduct(product_id, self.products[product_id]) if product_id in self.products else None
+
+    def get_userfields(self, entity, object_id):
+        return {}
+
+@pytest.fixture
+def designer(monkeypatch, font):
+    monkeypatch.chdir(ROOT)  # LabelDesigner reads config.json or config.example.json
+    import LabelDesigner as designer
+
+    family, style, path = font
+    monkeypatch.setattr(designer, 'FONTS', {family: {style: path}})
+    monkeypatch.setitem(designer.CONFIG['LABEL'], 'DEFAULT_FONTS', {'family': family, 'style': style})
+    monkeypatch.setitem(designer.CONFIG['PRINTER'], 'BACKEND', 'pdf')
+
+    grocy = FakeGrocy({93: 'Ofengemüse'})
+    monkeypatch.setattr(designer, 'grocy', grocy)
+    monkeypatch.setattr(designer, 'product_lookup', ProductLookup(grocy))
+    monkeypatch.setattr(designer, 'print_queue', PrintQueue())
+    monkeypatch.setattr(designer, 'printed', [], raising=False)
+    monkeypatch.setattr(designer, 'print_file', lambda data, job_name='Barcode Designer': designer.printed.append((job_name, data)) or len(designer.printed))
+    return designer
+
+def call(designer, method, path, form=None, json_body=None):
+    """ calls the bottle app like a HTTP client would; returns (status code, parsed JSON or body) """
+    import bottle
+    if json_body is not None:
+        body, content_type = json.dumps(json_body).encode('utf-8'), 'application/json'
+    else:
+        body, content_type = (urlencode(form or {}).encode('utf-8') if method == 'POST' else b''), 'application/x-www-form-urlencoded'
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+               'QUERY_STRING': urlencode(form or {}) if method == 'GET' else '', 'wsgi.url_scheme': 'http',
+               'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    started = []
+    result = b''.join(bottle.default_app()(environ, lambda status, headers, exc_info=None: started.append(status)))
+    try:
+        result = json.loads(result)
+    except ValueError:
+        pass
+    return int(started[0].split()[0]), result
+
+def test_grocy_webhook_prints_a_grocy_label(designer):
+    # the webhook sends neither printGrocy nor any label options
+    status, result = call(designer, 'POST', '/api/print/grocy', {'grocycode': 'grcy:p:93', 'product': 'Ofengemüse', 'due_date': '2024-12-29'})
+    assert status == 202 and result['success']
+    job = designer.print_queue.wait(result['job_id'], timeout=30)
+    assert job['state'] == 'printed', job.get('error')
+    assert [name for name, _ in designer.printed] == ['grcy:p:93.pdf']
+    assert designer.printed[0][1].startswith(b'%PDF')
+
+def test_unknown_grocycode(designer, monkeypatch):
+    from pygrocy.errors import GrocyError
+    def product_by_barcode(barcode):
+        raise GrocyError(SimpleNamespace(status_code=400, text=''))
+    monkeypatch.setattr(designer.grocy, 'product_by_barcode', product_by_barcode)
+    form = {'printGrocy': 'true', 'grocycode': 'grcy:p:4711', 'text': ' '}
+    status, result = call(designer, 'POST', '/api/preview/text', form)
+    assert status == 404 and result['error'] == 'Unknown grocycode grcy:p:4711'
+    status, result = call(designer, 'POST', '/api/print/text', form)
+    job = designer.print_queue.wait(result['job_id'], timeout=30)
+    assert job['state'] == 'failed' and job['error'] == 'Unknown grocycode grcy:p:4711'
+    assert designer.printed == []
+
+def test_warm_up_is_ready_without_grocy(designer, monkeypatch):
+    def unreachable():
+        raise ConnectionError('grocy.local is unreachable')
+    monkeypatch.setattr(designer, 'setup_grocy', unreachable)
+    monkeypatch.setattr(designer, 'WARMUP', {'fonts': False, 'render_pool': False, 'seconds': None})
+    designer.warm_up([path for styles in designer.FONTS.values() for path in styles.values()], [40])
+    status, result = call(designer, 'GET', '/api/ready')
+    assert status == 200 and result['warmup']['fonts'] and result['warmup']['render_pool']
+
+@pytest.mark.parametrize('preview_scale', ['nan', 'inf', '-inf', 'half'])
+def test_invalid_preview_scale_falls_back_to_the_default(designer, preview_scale):
+    status, result = call(designer, 'POST', '/api/preview/text', {'text': 'Ofengemüse', 'preview_scale': preview_scale})
+    assert status == 200 and result.startswith(b'\x89PNG')
+
+def test_batch_is_queued_and_reports_every_label(designer):
+    batch = {'defaults': {'numCopies': 2}, 'labels': [{'text': 'Regal 1'}, {'text': 'Regal 2', 'numCopies': 3}, {'label_size': 'x'}]}
+    status, result = call(designer, 'POST', '/api/print/batch', json_body=batch)
+    assert status == 202 and result['success']
+    job = designer.print_queue.wait(result['job_id'], timeout=30)
+    assert job['state'] == 'printed' and len(designer.printed) == 1
+    status, result = call(designer, 'GET', f"/api/jobs/{result['job_id']}")
+    assert [(label['success'], label.get('copies')) for label in result['job']['labels']] == [(True, 2), (True, 3), (False, None)]
+
+def test_batch_pages_are_limited(designer, monkeypatch):
+    monkeypatch.setitem(designer.CONFIG['PRINTER'], 'BATCH_MAX_PAGES', 10)
+    batch = {'labels': [{'text': 'Regal 1', 'numCopies': 6}, {'text': 'Regal 2', 'numCopies': 5}]}
+    status, result = call(designer, 'POST', '/api/print/batch', json_body=batch)
+    assert status == 400 and not result['success'] and '11 pages' in result['error']
+    assert designer.printed == []
+
+def test_batch_is_rejected_when_the_queue_is_full(designer, monkeypatch):
+    monkeypatch.setattr(designer, 'print_queue', PrintQueue(max_pending=0))
+    status, result = call(designer, 'POST', '/api/print/batch', json_body={'labels': [{'text': 'Regal 1'}]})
+    assert status == 429 and not result['success']
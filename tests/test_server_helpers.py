@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from server_helpers import PrintQueue, QueueFull
+
+def test_submit_returns_before_the_job_ran():
+    queue = PrintQueue()
+    release = threading.Event()
+    job, duplicate = queue.submit(None, 'label', lambda: release.wait(5) and 17)
+    assert not duplicate
+    assert job['id'] == 'q1' and job['state'] in ('queued', 'printing') and not job['finished']
+    release.set()
+    job = queue.wait(job['id'], timeout=5)
+    assert job['state'] == 'printed' and job['result'] == 17 and job['finished']
+    assert queue.stats()['pending'] == 0
+
+def test_full_queue_rejects_without_waiting():
+    queue = PrintQueue(workers=1, max_pending=2)
+    release = threading.Event()
+    jobs = [queue.submit(None, 'label', release.wait, 5)[0] for _ in range(2)]
+    with pytest.raises(QueueFull):
+        queue.submit(None, 'label', release.wait, 5)
+    assert queue.stats()['rejected'] == 1
+    release.set()
+    for job in jobs: queue.wait(job['id'], timeout=5)
+    queue.submit(None, 'label', release.wait, 5)
+
+def test_duplicates_get_the_first_job():
+    queue = PrintQueue(window=60)
+    first, _ = queue.submit(('grcy:p:1', '2024-12-29'), 'label', lambda: 1)
+    second, duplicate = queue.submit(('grcy:p:1', '2024-12-29'), 'label', lambda: 2)
+    assert duplicate and second['id'] == first['id']
+    assert queue.wait(first['id'], timeout=5)['result'] == 1
+    assert len(queue.jobs()) == 1
+
+def test_failed_job_is_reported_and_can_be_retried():
+    queue = PrintQueue(window=60)
+    def fail(): raise LookupError('Unknown grocycode grcy:p:0')
+    job, _ = queue.submit(('grcy:p:0', None), 'label', fail)
+    job = queue.wait(job['id'], timeout=5)
+    assert job['state'] == 'failed' and job['error'] == 'Unknown grocycode grcy:p:0' and job['finished']
+    retry, duplicate = queue.submit(('grcy:p:0', None), 'label', lambda: 3)
+    assert not duplicate and retry['id'] != job['id']
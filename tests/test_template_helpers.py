@@ -0,0 +1,38 @@
+import pytest
+
+import template_helpers
+from cache_helpers import LRUCache
+from template_helpers import compile_template
+
+TEMPLATE = {'fields': [
+    {'type': 'text',    'value': 'Vorrat', 'box': [1, 1, 20, 4], 'font_size': 30, 'align': 'left'},
+    {'type': 'text',    'value': '{product}\n{due_date}', 'box': [0, 6, 50, 10]},
+    {'type': 'barcode', 'value': '{grocycode}', 'box': [2, 16.5, 46, 8]},
+]}
+
+def grocy_label(font_path, **kwargs):
+    context = {'grocycode': 'grcy:p:93', 'product': 'Ofengemüse', 'due_date': '(2024-12-29)',
+               'width': 57, 'height': 32, 'dpi': 300, 'font_path': font_path, 'font_size': 40,
+               'margin_top': 0.0, 'margin_bottom': 0.0, 'margin_left': 0.0, 'margin_right': 0.0,
+               'align': 'center', 'vertical_align': 'top', 'mode': '1', 'debug': True}
+    context.update(kwargs)
+    return context
+
+@pytest.fixture
+def template_cache(monkeypatch):
+    cache = LRUCache(maxsize=64, max_bytes=template_helpers.TEMPLATE_CACHE.max_bytes, sizeof=template_helpers.TEMPLATE_CACHE.sizeof)
+    monkeypatch.setattr(template_helpers, 'TEMPLATE_CACHE', cache)
+    return cache
+
+def test_render_writes_no_files(font, template_cache, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    context = grocy_label(font[2])
+    compile_template(TEMPLATE, context).render(context)
+    assert list(tmp_path.iterdir()) == []
+
+def test_compiled_templates_are_bounded_by_size(font, template_cache):
+    template_cache.max_bytes = 1024 * 1024
+    compiled = [compile_template(TEMPLATE, grocy_label(font[2], width=width, height=50)) for width in range(50, 62)]
+    assert all(template.nbytes >= template.size[0] * template.size[1] for template in compiled)
+    assert template_cache.bytes <= template_cache.max_bytes
+    assert template_cache.stats()['evictions'] > 0
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import re
+
+from cache_helpers import LRUCache
+
+# Everything in parentheses is treated as one word
+TOKEN_PATTERN = re.compile(r'\([^)]*\)|\S+')
+
+METRICS_CACHE = LRUCache(maxsize=8192)
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text)
+
+def token_metrics(font, token):
+    """
+    Return (advance width, right edge, bottom edge) of `token` rendered in `font`.
+    Measurements are cached per font, so every word is measured only once.
+    """
+    key = (getattr(font, 'path', id(font)), getattr(font, 'size', None), token)
+    def measure():
+        bbox = font.getbbox(token)
+        return font.getlength(token), bbox[2], bbox[3]
+    return METRICS_CACHE.get_or_create(key, measure)
+
+def layout_lines(text, font, width):
+    """
+    Break `text` into lines that are at most `width` pixels wide.
+
+    The line width is accumulated token by token from the cached token
+    metrics instead of measuring every candidate line again.
+    Returns a list of (line, line width, line height) tuples where width
+    and height are the right and bottom edge of the line's bounding box.
+    """
+    space = token_metrics(font, ' ')[0]
+    lines = []
+    line, advance, right, bottom = [], 0, 0, 0
+    for token in tokenize(text):
+        token_advance, token_right, token_bottom = token_metrics(font, token)
+        start = advance + space if line else 0
+        if start + token_right <= width:
+            line.append(token)
+            advance, right, bottom = start + token_advance, start + token_right, max(bottom, token_bottom)
+        else:
+            lines.append((' '.join(line), round(right), bottom))
+            line, advance, right, bottom = [token], token_advance, token_right, token_bottom
+    if line:
+        lines.append((' '.join(line), round(right), bottom))
+    return lines
+
+def text_fits(img_size, text, font, kwargs, offset):
+    """ Return whether draw_multiline_text() could place `text` on an image of `img_size` """
+    width = img_size[0] - offset[1]
+    max_height = img_size[1]*1.1 // 2 if kwargs.get('topHalf', False) else img_size[1]
+    lines = layout_lines(text, font, width)
+    return (sum(line_height for _, _, line_height in lines) <= max_height
+            and all(line_width <= width for _, line_width, _ in lines))
+
+def fit_font_size(fits, max_size, min_size=1):
+    """
+    Binary search the largest font size in [min_size, max_size] for which
+    `fits(size)` is true. Returns min_size if not even that size fits.
+    """
+    if fits(max_size):
+        return max_size
+    low, high = min_size, max_size - 1
+    best = min_size
+    while low <= high:
+        size = (low + high) // 2
+        if fits(size):
+            best, low = size, size + 1
+        else:
+            high = size - 1
+    return best
+
+def place_lines(img_size, text, font, kwargs, offset):
+    """
+    Lay out `text` on an image of `img_size` like draw_multiline_text() draws it.
+    Returns a list of (x, y, line) with the top left position of every line.
+    """
+    width = img_size[0] - offset[1]  # Adjust for padding if needed
+
+    lines = layout_lines(text, font, width)
+    total_text_height = sum(line_height for _, _, line_height in lines)
+
+    # Determine available space based on `topHalf`
+    max_height = img_size[1]*1.1 // 2 if kwargs.get('topHalf', False) else img_size[1]
+    available_space = max_height - total_text_height
+
+    if available_space < 0:
+        raise ValueError("Text doesn't fit within the allowed dimensions")
+
+    # Determine gap size if vertical distribution is enabled
+    distribute_vertically = kwargs.get('distribute_vertically', False)
+    if distribute_vertically:
+        num_gaps = len(lines) + 1  # gaps between lines + gaps at top and bottom
+        gap_size = available_space // num_gaps
+        y = gap_size
+    else:
+        # Handle vertical alignment
+        vertical_align = kwargs.get('vertical_align', 'top')
+        if vertical_align == 'top':
+            y = kwargs.get('margin_top', 0)
+        elif vertical_align == 'center':
+            y = (max_height - total_text_height) // 2
+        elif vertical_align == 'bottom':
+            y = max_height - total_text_height - kwargs.get('margin_bottom', 0)
+        else:
+            raise ValueError("Invalid vertical_align value. Choose from 'top', 'center', or 'bottom'.")
+        gap_size = 0  # No additional gaps for non-distributed alignment
+
+    # Handle horizontal alignment of each line
+    align = kwargs.get('align', 'left')
+    placed = []
+    for line, line_width, line_height in lines:
+        if align == 'left':
+            x = kwargs.get('margin_left', 0)
+        elif align == 'center':
+            x = (img_size[0] - line_width) // 2
+        elif align == 'right':
+            x = img_size[0] - line_width - kwargs.get('margin_right', 0)
+        else:
+            raise ValueError("Invalid align value. Choose from 'left', 'center', or 'right'.")
+
+        placed.append((x, y, line))
+        y += line_height + gap_size
+
+    return placed
+
+def draw_lines(img, lines, font, kwargs):
+    """ Draw the (x, y, line) tuples returned by place_lines() """
+    from PIL import ImageDraw
+    draw = ImageDraw.Draw(img)
+    for x, y, line in lines:
+        draw.text((x, y), line, font=font, fill=kwargs.get('fill_color', 'black'))
+    return img
+
+def draw_multiline_text(img, text, font, kwargs, offset):
+    return draw_lines(img, place_lines(img.size, text, font, kwargs, offset), font, kwargs)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Vector PDF output of the labels: the text is written with an embedded
+subset of its TrueType font and the barcode bars are filled rectangles,
+so the documents are a few KB at any printer resolution.
+
+The labels are laid out by label_helpers (see label_layout()) exactly as
+for the raster output; this module only turns the layout into PDF drawing
+operations. fontTools and PIL are imported on first use.
+"""
+
+import hashlib, logging, re
+from io import BytesIO
+
+from cache_helpers import LRUCache
+from pdf_helpers import write_pdf, stream_object
+
+logger = logging.getLogger(__name__)
+
+FONT_SUBSET_CACHE = LRUCache(maxsize=64)
+
+# the tables a PDF viewer needs of an embedded TrueType font (glyphs are selected by id, no shaping)
+EMBEDDED_TABLES = {'head', 'hhea', 'maxp', 'hmtx', 'loca', 'glyf', 'cmap', 'OS/2', 'post'}
+
+TO_UNICODE_HEADER = b'''/CIDInit /ProcSet findresource begin
+12 dict begin
+begincmap
+/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def
+/CMapName /Adobe-Identity-UCS def
+/CMapType 2 def
+1 begincodespacerange
+<0000> <FFFF>
+endcodespacerange
+'''
+
+TO_UNICODE_FOOTER = b'''endcmap
+CMapName currentdict /CMap defineresource pop
+end
+end'''
+
+def subset_font(path, index, chars):
+    """
+    Return the subset of the TrueType font at `path` (collection index `index`)
+    with the glyphs of `chars` as dict: font program (bytes), glyph ids per
+    character, advance widths per glyph id and the descriptor metrics (all in
+    1/1000 em). Subsets are cached by font and characters.
+    """
+    def create():
+        from fontTools.ttLib import TTFont
+        from fontTools.subset import Subsetter, Options
+
+        font = TTFont(path, fontNumber=index)
+        if 'glyf' not in font:
+            raise ValueError(f'{path} has no TrueType outlines, vector output needs a .ttf font')
+        base_name = re.sub(r'[^A-Za-z0-9+\-]', '', font['name'].getDebugName(6) or 'Font') or 'Font'
+
+        options = Options()
+        options.hinting = False
+        options.layout_features = []
+        options.name_IDs = []
+        options.drop_tables += ['FFTM']
+        options.notdef_outline = True
+        subsetter = Subsetter(options)
+        subsetter.populate(unicodes=[ord(char) for char in chars])
+        subsetter.subset(font)
+        for table in set(font.keys()) - EMBEDDED_TABLES - {'GlyphOrder'}:
+            del font[table]
+
+        buffer = BytesIO()
+        font.save(buffer)
+
+        units = font['head'].unitsPerEm / 1000
+        cmap = font.getBestCmap() or {}
+        hmtx, hhea, head = font['hmtx'], font['hhea'], font['head']
+        os2 = font['OS/2'] if 'OS/2' in font else None
+        tag = ''.join(chr(65 + byte % 26) for byte in hashlib.md5(''.join(sorted(chars)).encode('utf-8')).digest()[:6])
+        return {
+            'program': buffer.getvalue(),
+            'name': f'{tag}+{base_name}',
+            'glyphs': {char: font.getGlyphID(cmap[ord(char)]) if ord(char) in cmap else 0 for char in chars},
+            'widths': [round(hmtx[name][0] / units) for name in font.getGlyphOrder()],
+            'bbox': [round(value / units) for value in (head.xMin, head.yMin, head.xMax, head.yMax)],
+            'ascent': round(hhea.ascent / units),
+            'descent': round(hhea.descent / units),
+            'cap_height': round(getattr(os2, 'sCapHeight', 0) / units) or round(hhea.ascent / units),
+            'italic_angle': font['post'].italicAngle,
+        }
+    return FONT_SUBSET_CACHE.get_or_create((path, index, frozenset(chars)), create)
+
+def font_objects(subset, first):
+    """
+    Return the objects of a Type0 font (numbered from `first`) for the subset:
+    the font, its CIDFont, font descriptor, font program and ToUnicode map.
+    Text is shown with 2-byte glyph ids (Identity-H encoding).
+    """
+    name = subset['name'].encode('ascii')
+    to_unicode = bytearray(TO_UNICODE_HEADER)
+    mappings = sorted((gid, char) for char, gid in subset['glyphs'].items() if gid)
+    for i in range(0, len(mappings), 100):
+        chunk = mappings[i:i + 100]
+        to_unicode += b'%d beginbfchar\n' % len(chunk)
+        for gid, char in chunk:
+            to_unicode += b'<%04X> <%s>\n' % (gid, char.encode('utf-16-be').hex().upper().encode('ascii'))
+        to_unicode += b'endbfchar\n'
+    to_unicode += TO_UNICODE_FOOTER
+
+    return [
+        b'<< /Type /Font /Subtype /Type0 /BaseFont /%s /Encoding /Identity-H '
+        b'/DescendantFonts [ %d 0 R ] /ToUnicode %d 0 R >>' % (name, first + 1, first + 4),
+        b'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /%s '
+        b'/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> '
+        b'/FontDescriptor %d 0 R /CIDToGIDMap /Identity /W [ 0 [ %s ] ] >>'
+        % (name, first + 2, b' '.join(b'%d' % width for width in subset['widths'])),
+        b'<< /Type /FontDescriptor /FontName /%s /Flags 4 /FontBBox [ %s ] /ItalicAngle %s '
+        b'/Ascent %d /Descent %d /CapHeight %d /StemV 80 /FontFile2 %d 0 R >>'
+        % (name, b' '.join(b'%d' % value for value in subset['bbox']), b'%g' % subset['italic_angle'],
+           subset['ascent'], subset['descent'], subset['cap_height'], first + 3),
+        stream_object(subset['program'], b' /Length1 %d' % len(subset['program'])),
+        stream_object(bytes(to_unicode)),
+    ]
+
+def label_content(layout, fonts):
+    """
+    Return the content stream (bytes) drawing a label layout, coordinates converted from px to pt.
+    `fonts` maps (font path, index) to (resource name, font object number, subset).
+    """
+    from PIL import ImageColor
+    k = 72.0 / layout['dpi']
+    height = layout['size'][1]
+    red, green, blue = (value / 255 for value in ImageColor.getrgb(layout['fill_color'])[:3])
+    ops = [b'%.3g %.3g %.3g rg' % (red, green, blue)]
+
+    for font, lines in layout['texts']:
+        if not lines: continue
+        resource, _, subset = fonts[(font.path, font.index)]
+        ascent = font.getmetrics()[0]
+        ops.append(b'BT /%s %.3f Tf' % (resource, font.size * k))
+        for x, y, line in lines:
+            glyphs = ''.join('%04X' % subset['glyphs'].get(char, 0) for char in line)
+            ops.append(b'1 0 0 1 %.3f %.3f Tm <%s> Tj' % (x * k, (height - y - ascent) * k, glyphs.encode('ascii')))
+        ops.append(b'ET')
+
+    for x, y, width, rect_height in layout['rects']:
+        ops.append(b'%.3f %.3f %.3f %.3f re' % (x * k, (height - y - rect_height) * k, width * k, rect_height * k))
+    if layout['rects']:
+        ops.append(b'f')
+    return b'\n'.join(ops)
+
+def layouts_to_vector_pdf(labels):
+    """
+    Return a PDF document (as bytes) for a list of (label layout, copies) tuples.
+    Every font is embedded once with the characters of all labels using it,
+    every label's drawing operations once; its copies are pages referring to them.
+    """
+    chars = {}
+    for layout, _ in labels:
+        for font, lines in layout['texts']:
+            if not isinstance(getattr(font, 'path', None), str):
+                raise ValueError('Vector output needs a font file, the default font cannot be embedded')
+            chars.setdefault((font.path, font.index), set()).update(''.join(line for _, _, line in lines) or ' ')
+
+    objects = [None, None]  # catalog and page tree are filled in by write_pdf()
+    fonts = {}
+    for number, (key, font_chars) in enumerate(chars.items()):
+        subset = subset_font(key[0], key[1], font_chars)
+        fonts[key] = (b'F%d' % number, len(objects) + 1, subset)
+        objects += font_objects(subset, len(objects) + 1)
+
+    pages = []
+    for layout, num_copies in labels:
+        objects.append(stream_object(label_content(layout, fonts)))
+        used = {(font.path, font.index) for font, _ in layout['texts']}
+        resources = b' '.join(b'/%s %d 0 R' % fonts[key][:2] for key in fonts if key in used)
+        k = 72.0 / layout['dpi']
+        page = (b'<< /Type /Page /Parent 2 0 R /MediaBox [ 0 0 %.4f %.4f ] '
+                b'/Resources << /Font << %s >> >> /Contents %d 0 R >>'
+                % (layout['size'][0] * k, layout['size'][1] * k, resources, len(objects)))
+        pages += [page] * max(int(num_copies), 1)
+
+    return write_pdf(objects, pages)